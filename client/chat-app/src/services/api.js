@@ -22,12 +22,22 @@ export const fetchAnthropicModels = async () => {
   }
 };
 
-export const generateOpenAIResponse = async (model, userPrompt, systemPrompt = '') => {
+// Pass an AbortSignal to cancel: aborting closes the connection, which also
+// cancels the upstream generation on the server.
+export const generateOpenAIResponse = async (model, userPrompt, systemPrompt = '', { requestId, signal, documentId } = {}) => {
   try {
     const response = await axios.post(`${API_URL}/openai/generate`, {
       model,
       prompt: userPrompt,
       system_prompt: systemPrompt,
+      ...(documentId ? { document_id: documentId } : {}),
+    }, {
+      // Requests from the chat UI are interactive and get scheduled ahead of bulk traffic
+      headers: {
+        'X-Priority': 'interactive',
+        ...(requestId ? { 'X-Request-ID': requestId } : {}),
+      },
+      signal,
     });
     return response.data.data;
   } catch (error) {
@@ -36,12 +46,22 @@ export const generateOpenAIResponse = async (model, userPrompt, systemPrompt = '
   }
 };
 
-export const generateAnthropicResponse = async (model, userPrompt, systemPrompt = '') => {
+// Pass an AbortSignal to cancel: aborting closes the connection, which also
+// cancels the upstream generation on the server.
+export const generateAnthropicResponse = async (model, userPrompt, systemPrompt = '', { requestId, signal, documentId } = {}) => {
   try {
     const response = await axios.post(`${API_URL}/anthropic/generate`, {
       model,
       prompt: userPrompt,
       system_prompt: systemPrompt,
+      ...(documentId ? { document_id: documentId } : {}),
+    }, {
+      // Requests from the chat UI are interactive and get scheduled ahead of bulk traffic
+      headers: {
+        'X-Priority': 'interactive',
+        ...(requestId ? { 'X-Request-ID': requestId } : {}),
+      },
+      signal,
     });
     return response.data.data;
   } catch (error) {
@@ -49,3 +69,157 @@ export const generateAnthropicResponse = async (model, userPrompt, systemPrompt
     throw error;
   }
 };
+
+// Uploads a document (File or Blob) once; pass the returned id as documentId
+// to ask questions about it without re-sending its contents.
+export const uploadDocument = async (file) => {
+  try {
+    const response = await axios.post(`${API_URL}/documents`, file, {
+      headers: {
+        'Content-Type': file.type || 'text/plain',
+        ...(file.name ? { 'X-Filename': file.name } : {}),
+      },
+    });
+    return response.data.data;
+  } catch (error) {
+    console.error('Error uploading document:', error);
+    throw error;
+  }
+};
+
+// Cancels an in-flight generate or compare request started with the given requestId.
+export const cancelRequest = async (requestId) => {
+  try {
+    const response = await axios.post(`${API_URL}/requests/${encodeURIComponent(requestId)}/cancel`);
+    return response.data.data;
+  } catch (error) {
+    console.error('Error cancelling request:', error);
+    throw error;
+  }
+};
+
+// Runs one prompt against several { provider, model } targets in parallel.
+// onResult is called with each target's result as soon as it finishes.
+export const compareModels = async (targets, userPrompt, systemPrompt = '', onResult = () => {}) => {
+  try {
+    const response = await fetch(`${API_URL}/compare`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({
+        targets,
+        prompt: userPrompt,
+        system_prompt: systemPrompt,
+      }),
+    });
+    if (!response.ok) {
+      throw new Error(`Compare request failed with status ${response.status}`);
+    }
+
+    // The server streams newline-delimited JSON, one line per finished target
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    const results = [];
+    let buffer = '';
+    let summary = null;
+
+    for (;;) {
+      const { done, value } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      const lines = buffer.split('\n');
+      buffer = lines.pop();
+      for (const line of lines) {
+        if (!line.trim()) continue;
+        const event = JSON.parse(line);
+        if (event.type === 'done') {
+          summary = event;
+        } else {
+          results.push(event);
+          onResult(event);
+        }
+      }
+    }
+    return { results, totalLatencyMs: summary ? summary.total_latency_ms : null };
+  } catch (error) {
+    console.error('Error comparing models:', error);
+    throw error;
+  }
+};
+
+const WS_URL = API_URL.replace(/^http/, 'ws');
+
+// Persistent WebSocket chat connection. Several generations can run at once;
+// each is identified by an ID and can be cancelled independently.
+export class ChatSocket {
+  constructor() {
+    this.socket = null;
+    this.handlers = new Map();
+    this.nextId = 1;
+  }
+
+  connect() {
+    if (this.socket && this.socket.readyState <= WebSocket.OPEN) {
+      return this.ready;
+    }
+    this.socket = new WebSocket(`${WS_URL}/ws/chat`);
+    this.socket.onmessage = (event) => this.handleMessage(JSON.parse(event.data));
+    this.socket.onclose = () => {
+      // Fail any generations that were still running on this connection
+      for (const handler of this.handlers.values()) {
+        handler.onError?.(new Error('Chat connection closed'));
+      }
+      this.handlers.clear();
+    };
+    this.ready = new Promise((resolve, reject) => {
+      this.socket.onopen = () => resolve();
+      this.socket.onerror = (error) => {
+        console.error('Chat socket error:', error);
+        reject(error);
+      };
+    });
+    return this.ready;
+  }
+
+  handleMessage(message) {
+    const handler = this.handlers.get(message.id);
+    if (!handler) {
+      if (message.type === 'error') console.error('Chat socket error:', message.message);
+      return;
+    }
+    if (message.type === 'token') {
+      handler.onToken?.(message.text);
+      return;
+    }
+    this.handlers.delete(message.id);
+    if (message.type === 'done') handler.onDone?.(message);
+    else if (message.type === 'cancelled') handler.onCancelled?.();
+    else if (message.type === 'error') handler.onError?.(new Error(message.message));
+  }
+
+  // Starts a generation and returns its ID. Handlers: onToken, onDone, onCancelled, onError.
+  async generate(provider, model, userPrompt, systemPrompt = '', handlers = {}) {
+    await this.connect();
+    const id = String(this.nextId++);
+    this.handlers.set(id, handlers);
+    this.socket.send(JSON.stringify({
+      type: 'generate',
+      id,
+      provider,
+      model,
+      prompt: userPrompt,
+      system_prompt: systemPrompt,
+    }));
+    return id;
+  }
+
+  cancel(id) {
+    if (this.socket && this.socket.readyState === WebSocket.OPEN) {
+      this.socket.send(JSON.stringify({ type: 'cancel', id }));
+    }
+  }
+
+  close() {
+    if (this.socket) this.socket.close();
+  }
+}
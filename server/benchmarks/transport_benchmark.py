@@ -0,0 +1,195 @@
+"""
+Transport Benchmark
+
+Measures the per-request connection overhead of the OpenAI SDK client against
+a local HTTPS stand-in for the Responses API. Two setups are compared:
+
+- default: the SDK's stock HTTP client (5s keep-alive expiry, no pre-warming)
+- tuned: the shared client from src.transport.http_client, pre-warmed
+
+The fake server adds a simulated network round-trip time to every request and
+two extra round trips to every new connection (TCP + TLS handshake), and counts
+how many connections each setup opens.
+
+Usage (from the server directory, requires the openssl CLI):
+    python -m benchmarks.transport_benchmark [--requests 20] [--rtt-ms 20] [--idle 6]
+
+Author: Pradyun Magal
+Date: March 2025
+"""
+
+import argparse
+import json
+import os
+import socket
+import ssl
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+import openai
+
+from src.transport.http_client import TransportConfig, build_http_client, prewarm_connections
+
+# Minimal non-streaming Responses API payload
+FAKE_RESPONSE = {
+    "id": "resp_bench",
+    "object": "response",
+    "created_at": 0,
+    "model": "bench-model",
+    "output": [{
+        "type": "message",
+        "id": "msg_bench",
+        "status": "completed",
+        "role": "assistant",
+        "content": [{"type": "output_text", "text": "ok", "annotations": []}]
+    }],
+    "parallel_tool_calls": False,
+    "tool_choice": "auto",
+    "tools": [],
+    "usage": {
+        "input_tokens": 1,
+        "output_tokens": 1,
+        "total_tokens": 2,
+        "input_tokens_details": {"cached_tokens": 0},
+        "output_tokens_details": {"reasoning_tokens": 0}
+    }
+}
+
+
+class FakeProviderServer(ThreadingHTTPServer):
+    """HTTPS server that simulates network latency and counts new connections."""
+
+    daemon_threads = True
+
+    def __init__(self, cert_file: str, key_file: str, rtt: float):
+        super().__init__(("127.0.0.1", 0), FakeProviderHandler)
+        self.rtt = rtt
+        self.connections = 0
+        self._lock = threading.Lock()
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert_file, key_file)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+
+    def finish_request(self, request, client_address):
+        # A new connection costs a TCP and a TLS round trip before the first byte
+        with self._lock:
+            self.connections += 1
+        request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        time.sleep(2 * self.rtt)
+        super().finish_request(request, client_address)
+
+    @property
+    def base_url(self) -> str:
+        return f"https://localhost:{self.server_address[1]}/v1"
+
+
+class FakeProviderHandler(BaseHTTPRequestHandler):
+    """Answers every request with a fixed Responses API payload."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, body: bytes) -> None:
+        time.sleep(self.server.rtt)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self._reply(b"")
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self._reply(json.dumps(FAKE_RESPONSE).encode())
+
+
+def make_certificate(directory: str) -> Dict[str, str]:
+    """Create a self-signed certificate for localhost with the openssl CLI."""
+    cert_file = os.path.join(directory, "cert.pem")
+    key_file = os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-keyout", key_file, "-out", cert_file, "-subj", "/CN=localhost",
+         "-addext", "subjectAltName=DNS:localhost"],
+        check=True, capture_output=True
+    )
+    return {"cert": cert_file, "key": key_file}
+
+
+def run_scenario(client: openai.OpenAI, server: FakeProviderServer, requests: int,
+                 idle: float) -> Dict[str, float]:
+    """Time a cold request, a run of warm requests, and one request after an idle gap."""
+    def timed() -> float:
+        start = time.perf_counter()
+        client.responses.create(model="bench-model", input="ping")
+        return (time.perf_counter() - start) * 1000
+
+    connections_before = server.connections
+    first_ms = timed()
+    warm_ms: List[float] = [timed() for _ in range(requests)]
+    time.sleep(idle)
+    after_idle_ms = timed()
+
+    return {
+        "first_ms": first_ms,
+        "warm_mean_ms": statistics.mean(warm_ms),
+        "warm_p95_ms": sorted(warm_ms)[int(len(warm_ms) * 0.95) - 1],
+        "after_idle_ms": after_idle_ms,
+        "connections": server.connections - connections_before
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20, help="warm requests per scenario")
+    parser.add_argument("--rtt-ms", type=float, default=20.0, help="simulated network round trip")
+    parser.add_argument("--idle", type=float, default=6.0, help="idle gap before the last request (s)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        files = make_certificate(directory)
+        server = FakeProviderServer(files["cert"], files["key"], args.rtt_ms / 1000)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        # Pay one-off process costs (lazy imports, model parsing) outside the measurements
+        warmup_client = openai.OpenAI(
+            api_key="bench", base_url=server.base_url,
+            http_client=openai.DefaultHttpxClient(verify=files["cert"])
+        )
+        warmup_client.responses.create(model="bench-model", input="ping")
+        warmup_client.close()
+
+        # Before: the SDK's own client, trusting the test certificate
+        default_client = openai.OpenAI(
+            api_key="bench", base_url=server.base_url,
+            http_client=openai.DefaultHttpxClient(verify=files["cert"])
+        )
+        default = run_scenario(default_client, server, args.requests, args.idle)
+
+        # After: the shared tuned client, pre-warmed as the app does at startup
+        config = TransportConfig(verify=files["cert"], prewarm_connections=1)
+        http_client = build_http_client(config)
+        prewarm_connections(http_client, [server.base_url], config.prewarm_connections)
+        tuned_client = openai.OpenAI(api_key="bench", base_url=server.base_url, http_client=http_client)
+        tuned = run_scenario(tuned_client, server, args.requests, args.idle)
+
+        server.shutdown()
+
+    print(f"Simulated RTT {args.rtt_ms:.0f} ms, {args.requests} warm requests, {args.idle:.0f}s idle gap")
+    print("(tuned connections exclude the ones opened by pre-warming)\n")
+    print(f"{'metric':<16}{'default':>12}{'tuned':>12}")
+    for key in ("first_ms", "warm_mean_ms", "warm_p95_ms", "after_idle_ms", "connections"):
+        print(f"{key:<16}{default[key]:>12.1f}{tuned[key]:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""
+Request Cancellation
+
+This module tracks in-flight generation requests by ID so they can be
+cancelled, either explicitly through the cancel endpoint or because the client
+disconnected. Cancelling a request runs its registered callbacks, which close
+the upstream provider stream and free the worker immediately.
+
+Author: Pradyun Magal
+Date: March 2025
+"""
+
+import logging
+import select
+import socket
+import threading
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from src.errors.exceptions import RequestCancelledError
+
+# Configure module logger
+logger = logging.getLogger(__name__)
+
+# Cancellation reasons reported in metrics
+REASON_EXPLICIT = "explicit"
+REASON_CLIENT_DISCONNECT = "client_disconnect"
+REASON_SLOW_CLIENT = "slow_client"
+
+# How often the disconnect watcher polls the client socket, in seconds
+DISCONNECT_POLL_INTERVAL = 0.25
+
+
+class CancellationToken:
+    """
+    Thread-safe cancellation signal for one request.
+
+    Callbacks added with add_callback run once, on the thread that cancels.
+    They are used to close upstream HTTP streams so a blocked reader wakes up.
+    """
+
+    def __init__(self):
+        self.reason: Optional[str] = None
+        self._event = threading.Event()
+        self._finished = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], Any]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        """Whether the request has been cancelled."""
+        return self._event.is_set()
+
+    @property
+    def finished(self) -> bool:
+        """Whether the request has completed, successfully or not."""
+        return self._finished.is_set()
+
+    def cancel(self, reason: str = REASON_EXPLICIT) -> bool:
+        """
+        Cancel the request and run its callbacks.
+
+        Args:
+            reason: Why the request was cancelled
+
+        Returns:
+            True if this call cancelled the request, False if it was already
+            cancelled or had finished
+        """
+        with self._lock:
+            if self._event.is_set() or self._finished.is_set():
+                return False
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for callback in callbacks:
+            self._run_callback(callback)
+        return True
+
+    def add_callback(self, callback: Callable[[], Any]) -> None:
+        """
+        Register a callback to run on cancellation.
+
+        If the request is already cancelled the callback runs immediately.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        self._run_callback(callback)
+
+    def finish(self) -> None:
+        """Mark the request as complete; later cancellations are ignored."""
+        with self._lock:
+            self._finished.set()
+            self._callbacks = []
+
+    def raise_if_cancelled(self) -> None:
+        """
+        Stop the caller if the request has been cancelled.
+
+        Raises:
+            RequestCancelledError: If the request has been cancelled
+        """
+        if self._event.is_set():
+            raise RequestCancelledError(self.reason or REASON_EXPLICIT)
+
+    @staticmethod
+    def _run_callback(callback: Callable[[], Any]) -> None:
+        try:
+            callback()
+        except Exception as e:
+            logger.warning(f"Error in cancellation callback: {str(e)}")
+
+
+class RequestRegistry:
+    """
+    Registry of in-flight requests keyed by request ID.
+
+    This class handles:
+    - Issuing a cancellation token for each request
+    - Cancelling requests by ID
+    - Counting completed and cancelled requests for metrics
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens: Dict[str, CancellationToken] = {}
+        self._completed = 0
+        self._cancelled: Dict[str, int] = {}
+
+    def register(self, request_id: Optional[str] = None) -> Tuple[str, CancellationToken]:
+        """
+        Register a new in-flight request.
+
+        Args:
+            request_id: Client-chosen ID (a random one is generated if omitted)
+
+        Returns:
+            A tuple of (request ID, cancellation token)
+
+        Raises:
+            ValueError: If the request ID is already in use
+        """
+        request_id = request_id or uuid.uuid4().hex
+        token = CancellationToken()
+        with self._lock:
+            if request_id in self._tokens:
+                raise ValueError(f"Request ID '{request_id}' is already in use")
+            self._tokens[request_id] = token
+        return request_id, token
+
+    def unregister(self, request_id: str) -> None:
+        """
+        Remove a request once it has finished and update the counters.
+
+        Args:
+            request_id: The ID the request was registered under
+        """
+        with self._lock:
+            token = self._tokens.pop(request_id, None)
+            if token is None:
+                return
+            token.finish()
+            if token.cancelled:
+                reason = token.reason or REASON_EXPLICIT
+                self._cancelled[reason] = self._cancelled.get(reason, 0) + 1
+            else:
+                self._completed += 1
+
+    def cancel(self, request_id: str, reason: str = REASON_EXPLICIT) -> bool:
+        """
+        Cancel an in-flight request.
+
+        Args:
+            request_id: The ID the request was registered under
+            reason: Why the request was cancelled
+
+        Returns:
+            True if the request was found and cancelled, False otherwise
+        """
+        with self._lock:
+            token = self._tokens.get(request_id)
+        if token is None:
+            return False
+        cancelled = token.cancel(reason)
+        if cancelled:
+            logger.info(f"Cancelled request '{request_id}' ({reason})")
+        return cancelled
+
+    def metrics(self) -> Dict[str, Any]:
+        """Return the in-flight, completed and cancelled request counts."""
+        with self._lock:
+            return {
+                "in_flight": len(self._tokens),
+                "completed": self._completed,
+                "cancelled": dict(self._cancelled),
+                "cancelled_total": sum(self._cancelled.values())
+            }
+
+
+def watch_for_disconnect(environ: Dict[str, Any], token: CancellationToken) -> None:
+    """
+    Cancel a request if its client closes the connection.
+
+    WSGI gives no disconnect notification while a view is blocked, so this
+    polls the client socket on a daemon thread when the server exposes it
+    (the Werkzeug server does, as `werkzeug.socket`). Under servers that do
+    not, requests can still be cancelled explicitly by ID.
+
+    Args:
+        environ: The WSGI environment of the request
+        token: The request's cancellation token
+    """
+    sock = environ.get("werkzeug.socket")
+    if sock is None:
+        return
+
+    def poll() -> None:
+        while not token.finished and not token.cancelled:
+            try:
+                readable, _, _ = select.select([sock], [], [], DISCONNECT_POLL_INTERVAL)
+                if not readable:
+                    continue
+                # A readable socket with no data means the peer closed it
+                if sock.recv(1, socket.MSG_PEEK) == b"":
+                    token.cancel(REASON_CLIENT_DISCONNECT)
+                # Otherwise the client sent more data (e.g. a pipelined
+                # request); we can no longer tell, so stop watching
+                return
+            except (OSError, ValueError):
+                token.cancel(REASON_CLIENT_DISCONNECT)
+                return
+
+    threading.Thread(target=poll, name="disconnect-watcher", daemon=True).start()
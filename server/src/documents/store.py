@@ -0,0 +1,236 @@
+"""
+Document Store
+
+This module stores uploaded documents on disk so large prompts can be sent
+once and referenced by ID afterwards. Uploads are streamed to disk in chunks
+with a size cap and checked to be UTF-8 text on the way, and documents are deduplicated by the SHA-256 of their
+content, which doubles as the document ID.
+
+Loaded document text is kept in a small LRU cache. Every request that refers
+to the same document shares one string instead of re-reading and copying it.
+
+Author: Pradyun Magal
+Date: March 2025
+"""
+
+import codecs
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Any, BinaryIO
+
+from src.errors.exceptions import (
+    DocumentNotFoundError, DocumentTooLargeError, EmptyDocumentError, InvalidDocumentEncodingError
+)
+
+# Configure module logger
+logger = logging.getLogger(__name__)
+
+# Defaults (overridable via environment variables, see create_document_store)
+DEFAULT_DOCUMENT_DIR = "documents"
+DEFAULT_MAX_BYTES = 20 * 1024 * 1024
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+# Size of each chunk read from the upload stream
+CHUNK_SIZE = 64 * 1024
+
+# Document IDs are lowercase SHA-256 hex digests
+DOCUMENT_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+def is_document_id(value: Any) -> bool:
+    """Whether a value is a well-formed document ID."""
+    return isinstance(value, str) and DOCUMENT_ID_PATTERN.match(value) is not None
+
+
+@dataclass
+class DocumentInfo:
+    """Metadata about a stored document."""
+    id: str
+    size: int
+    filename: str = ""
+    content_type: str = ""
+
+
+@dataclass
+class DocumentContent:
+    """The text of a stored document, ready to be placed in a prompt."""
+    id: str
+    text: str
+
+
+class DocumentStore:
+    """
+    Content-addressed store for uploaded documents.
+
+    This class handles:
+    - Streaming uploads to disk with a size cap and UTF-8 validation
+    - Deduplicating documents by content hash
+    - Loading document text through a bounded LRU cache
+    """
+
+    def __init__(self, root: str = DEFAULT_DOCUMENT_DIR, max_bytes: int = DEFAULT_MAX_BYTES,
+                 cache_bytes: int = DEFAULT_CACHE_BYTES):
+        """
+        Initialize the store.
+
+        Args:
+            root: Directory the documents are written to
+            max_bytes: Maximum size of a single document
+            cache_bytes: Approximate budget for cached document text
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.cache_bytes = cache_bytes
+
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        self._cached_size = 0
+
+        os.makedirs(root, exist_ok=True)
+        logger.info(f"DocumentStore initialized in '{root}'")
+
+    def _path(self, document_id: str) -> str:
+        return os.path.join(self.root, document_id)
+
+    def _meta_path(self, document_id: str) -> str:
+        return os.path.join(self.root, f"{document_id}.json")
+
+    def save(self, stream: BinaryIO, filename: str = "", content_type: str = "") -> DocumentInfo:
+        """
+        Stream a document to disk, hashing it as it is written.
+
+        Args:
+            stream: File-like object to read the document from
+            filename: Original file name (optional)
+            content_type: MIME type reported by the client (optional)
+
+        Returns:
+            Metadata for the stored document. If identical content was already
+            stored, the existing document is returned.
+
+        Raises:
+            DocumentTooLargeError: If the document exceeds max_bytes
+            EmptyDocumentError: If the upload has no content
+            InvalidDocumentEncodingError: If the upload is not valid UTF-8
+        """
+        digest = hashlib.sha256()
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=self.root, prefix=".upload-")
+        try:
+            with os.fdopen(fd, "wb") as temp_file:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise DocumentTooLargeError(self.max_bytes)
+                    self._check_utf8(decoder, chunk)
+                    digest.update(chunk)
+                    temp_file.write(chunk)
+            # Fails if the upload ends in the middle of a multi-byte character
+            self._check_utf8(decoder, b"", final=True)
+
+            if size == 0:
+                raise EmptyDocumentError()
+
+            document_id = digest.hexdigest()
+            info = DocumentInfo(id=document_id, size=size, filename=filename, content_type=content_type)
+
+            if os.path.exists(self._path(document_id)):
+                logger.info(f"Document '{document_id}' already stored, reusing it")
+                os.remove(temp_path)
+                return self.get_info(document_id)
+
+            # Write the metadata first so a visible document always has it
+            with open(self._meta_path(document_id), "w") as meta_file:
+                json.dump(asdict(info), meta_file)
+            os.replace(temp_path, self._path(document_id))
+
+            logger.info(f"Stored document '{document_id}' ({size} bytes)")
+            return info
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    @staticmethod
+    def _check_utf8(decoder: codecs.IncrementalDecoder, chunk: bytes, final: bool = False) -> None:
+        """Feed a chunk to the incremental UTF-8 decoder, raising if it is not valid UTF-8."""
+        try:
+            decoder.decode(chunk, final)
+        except UnicodeDecodeError:
+            raise InvalidDocumentEncodingError() from None
+
+    def get_info(self, document_id: Any) -> DocumentInfo:
+        """
+        Get the metadata of a stored document.
+
+        Raises:
+            DocumentNotFoundError: If the document does not exist
+        """
+        if not is_document_id(document_id):
+            raise DocumentNotFoundError(str(document_id))
+        try:
+            with open(self._meta_path(document_id)) as meta_file:
+                return DocumentInfo(**json.load(meta_file))
+        except FileNotFoundError:
+            raise DocumentNotFoundError(document_id) from None
+
+    def load(self, document_id: Any) -> DocumentContent:
+        """
+        Load the text of a stored document.
+
+        The text is decoded once and cached, so every request for the same
+        document shares a single string.
+
+        Raises:
+            DocumentNotFoundError: If the document does not exist
+        """
+        if not is_document_id(document_id):
+            raise DocumentNotFoundError(str(document_id))
+
+        with self._lock:
+            text = self._cache.get(document_id)
+            if text is not None:
+                self._cache.move_to_end(document_id)
+                return DocumentContent(id=document_id, text=text)
+
+        try:
+            with open(self._path(document_id), "rb") as document_file:
+                text = document_file.read().decode("utf-8", errors="replace")
+        except FileNotFoundError:
+            raise DocumentNotFoundError(document_id) from None
+
+        self._cache_text(document_id, text)
+        return DocumentContent(id=document_id, text=text)
+
+    def _cache_text(self, document_id: str, text: str) -> None:
+        """Add text to the LRU cache, evicting the oldest entries over budget."""
+        if len(text) > self.cache_bytes:
+            return
+        with self._lock:
+            if document_id in self._cache:
+                return
+            self._cache[document_id] = text
+            self._cached_size += len(text)
+            while self._cached_size > self.cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_size -= len(evicted)
+
+
+def create_document_store() -> DocumentStore:
+    """Helper function to create a store configured from environment variables."""
+    return DocumentStore(
+        root=os.getenv("DOCUMENT_DIR", DEFAULT_DOCUMENT_DIR),
+        max_bytes=int(os.getenv("DOCUMENT_MAX_BYTES", str(DEFAULT_MAX_BYTES))),
+        cache_bytes=int(os.getenv("DOCUMENT_CACHE_BYTES", str(DEFAULT_CACHE_BYTES)))
+    )
@@ -34,3 +34,43 @@ class APIError(BaseError):
     """Raised when there's an error with the external API."""
     def __init__(self, message="API error"):
         super().__init__(message)
+
+
+class RequestCancelledError(BaseError):
+    """Raised when an in-flight request is cancelled before it completes."""
+    def __init__(self, reason="cancelled"):
+        self.reason = reason
+        super().__init__(f"Request cancelled ({reason})")
+
+
+class DocumentNotFoundError(BaseError):
+    """Raised when a referenced document does not exist."""
+    def __init__(self, document_id=""):
+        message = "Document not found"
+        if document_id:
+            message = f"Document '{document_id}' not found"
+        super().__init__(message)
+
+
+class DocumentTooLargeError(BaseError):
+    """Raised when an uploaded document exceeds the size limit."""
+    def __init__(self, max_bytes=0):
+        super().__init__(f"Document exceeds the {max_bytes} byte limit")
+
+
+class EmptyDocumentError(BaseError):
+    """Raised when an uploaded document has no content."""
+    def __init__(self):
+        super().__init__("Document is empty")
+
+
+class InvalidDocumentEncodingError(BaseError):
+    """Raised when an uploaded document is not valid UTF-8 text."""
+    def __init__(self):
+        super().__init__("Document is not valid UTF-8 text")
+
+
+class SchedulerOverloadedError(BaseError):
+    """Raised when a request cannot be admitted by a provider scheduler in time."""
+    def __init__(self, message="Provider is overloaded"):
+        super().__init__(message)
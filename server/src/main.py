@@ -9,22 +9,56 @@ Author: Pradyun Magal
 Date: March 2025
 """
 
+import json
 import logging
-from flask import Flask, jsonify, request
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import asdict
+from typing import Optional
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
+from flask_sock import Sock
 from pydantic import BaseModel
 
 # Import response models
 from src.models.succ_response import create_success_response, SuccResponse
 from src.models.err_response import (
     ErrorResponse, ErrorCodes, ErrorMessages,
-    bad_request, unauthorized, not_found, internal_server_error
+    bad_request, unauthorized, not_found, internal_server_error, client_closed_request,
+    payload_too_large, service_unavailable
+)
+from src.errors.exceptions import (
+    DocumentNotFoundError, DocumentTooLargeError, EmptyDocumentError, InvalidDocumentEncodingError,
+    RequestCancelledError, SchedulerOverloadedError
 )
 
 # Import AI model managers
+from src.managers.base_manager import first_token_latency
 from src.managers.openai_manager import OpenAIManager
 from src.managers.anthropic_manager import AnthropicManager
 
+# Import request cancellation
+from src.cancellation.registry import RequestRegistry, watch_for_disconnect, REASON_CLIENT_DISCONNECT
+
+# Import document store
+from src.documents.store import DocumentContent, create_document_store
+
+# Import WebSocket chat session
+from src.sockets.chat_socket import ChatSocketSession
+
+# Import provider schedulers
+from src.scheduling.scheduler import PRIORITIES, PRIORITY_DEFAULT, create_provider_scheduler
+
+# Import shared HTTP transport
+from src.transport.http_client import (
+    add_throttle_listener, get_shared_http_client, get_transport_config, prewarm_connections
+)
+
+# Import usage ledger
+from src.usage.ledger import create_usage_ledger
+
 # Configure logging with timestamp and log level
 logging.basicConfig(
     level=logging.INFO,
@@ -35,17 +69,104 @@ logger = logging.getLogger(__name__)
 # Initialize Flask app
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
+sock = Sock(app)  # Enable WebSocket routes
 
 # Initialize AI model managers
 openai_manager = OpenAIManager()
 anthropic_manager = AnthropicManager()
 
+# Open upstream connections in the background so the first requests skip the handshakes
+transport_config = get_transport_config()
+threading.Thread(
+    target=prewarm_connections,
+    args=(get_shared_http_client(),
+          [str(openai_manager.client.base_url), str(anthropic_manager.client.base_url)],
+          transport_config.prewarm_connections),
+    name="http-prewarm-startup",
+    daemon=True
+).start()
+
+# Initialize the usage ledger and attach it to every manager
+usage_ledger = create_usage_ledger()
+openai_manager.set_usage_ledger(usage_ledger)
+anthropic_manager.set_usage_ledger(usage_ledger)
+
 # Map of provider names to their respective managers
 model_managers = {
     "openai": openai_manager,
     "anthropic": anthropic_manager
 }
 
+# Per-provider schedulers that admit upstream calls by priority and adaptive limit
+provider_schedulers = {provider: create_provider_scheduler(provider) for provider in model_managers}
+
+# Every 429 from a provider, including ones the SDK retries, shrinks its limit
+for provider, manager in model_managers.items():
+    add_throttle_listener(str(manager.client.base_url), provider_schedulers[provider].record_throttle)
+
+# Store for uploaded documents referenced by generate requests
+document_store = create_document_store()
+
+# Registry of in-flight generations, used for cancellation and metrics
+request_registry = RequestRegistry()
+
+# Maximum number of (provider, model) targets in a single compare request
+MAX_COMPARE_TARGETS = 8
+
+# Pools that run compare targets concurrently, one per provider and priority
+# class. A target holds its worker while it waits in the provider's scheduler,
+# so queued bulk targets must not occupy the workers interactive targets need.
+compare_executors = {
+    (provider, priority): ThreadPoolExecutor(
+        max_workers=int(os.getenv("COMPARE_MAX_WORKERS", "16")),
+        thread_name_prefix=f"compare-{provider}-{priority}"
+    )
+    for provider in model_managers
+    for priority in PRIORITIES
+}
+
+def get_client_key() -> str:
+    """
+    Identify the calling client for usage accounting.
+    
+    Uses the X-Client-Key header when present, falling back to the remote address.
+    """
+    return request.headers.get("X-Client-Key") or request.remote_addr or "anonymous"
+
+def get_request_id() -> str:
+    """
+    Get the client-chosen request ID from the X-Request-ID header, if any.
+    
+    Clients that send one can cancel the request through the cancel endpoint.
+    Without it the server generates an ID the client only learns once the
+    request has finished.
+    """
+    return request.headers.get("X-Request-ID", "")
+
+def get_priority(data: Optional[dict] = None) -> str:
+    """
+    Get the request's priority class from the X-Priority header or the body's `priority`.
+    
+    Raises:
+        ValueError: If the priority class is unknown
+    """
+    priority = request.headers.get("X-Priority") or (data or {}).get("priority") or PRIORITY_DEFAULT
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority '{priority}'")
+    return priority
+
+def load_document(data: dict) -> Optional[DocumentContent]:
+    """
+    Load the document referenced by a request body's `document_id`, if any.
+    
+    Raises:
+        DocumentNotFoundError: If the referenced document does not exist
+    """
+    document_id = data.get("document_id")
+    if not document_id:
+        return None
+    return document_store.load(document_id)
+
 @app.route('/health', methods=['GET'])
 def health():
     """
@@ -141,9 +262,16 @@ def generate_openai_response():
     {
         "model": "model-id",
         "prompt": "User prompt text",
-        "system_prompt": "Optional system instructions" (optional)
+        "system_prompt": "Optional system instructions" (optional),
+        "document_id": "ID returned by /api/documents" (optional),
+        "priority": "interactive" | "default" | "bulk" (optional, or X-Priority header)
     }
     
+    To be able to cancel the request while it runs, send an X-Request-ID header
+    and pass that ID to /api/requests/<request_id>/cancel. The response only
+    arrives once generation ends, so the `request_id` it echoes is too late to
+    cancel with.
+    
     Returns:
         JSON response with the generated text
     """
@@ -167,16 +295,34 @@ def generate_openai_response():
         model_id = data["model"]
         prompt = data["prompt"]
         system_prompt = data.get("system_prompt", "")
+        document = load_document(data)
+        priority = get_priority(data)
         
         logger.info(f"Generating response using OpenAI model: {model_id}")
         if system_prompt:
             logger.info("System prompt provided")
         
+        # Register the request so a disconnect or cancel call aborts it upstream
+        request_id, cancel_token = request_registry.register(get_request_id())
+        watch_for_disconnect(request.environ, cancel_token)
+        
         # Set the model and generate response
-        openai_manager.set_model(model_id)
-        response_text = openai_manager.generate_response(prompt, system_prompt)
+        try:
+            openai_manager.set_model(model_id)
+            result = provider_schedulers["openai"].run(
+                lambda: openai_manager.generate(
+                    prompt, system_prompt, get_client_key(), model=model_id,
+                    cancel_token=cancel_token, document=document
+                ),
+                priority,
+                cancel_token,
+                first_token_latency
+            )
+        finally:
+            request_registry.unregister(request_id)
         
         # Ensure the response is a string
+        response_text = result.text
         if not isinstance(response_text, str):
             response_text = str(response_text)
         
@@ -184,9 +330,19 @@ def generate_openai_response():
         return create_success_response({
             "response": response_text,
             "model": model_id,
-            "provider": "openai"
+            "provider": "openai",
+            "request_id": request_id
         }).to_response()
         
+    except DocumentNotFoundError as e:
+        logger.warning(str(e))
+        return not_found().to_response()
+    except SchedulerOverloadedError as e:
+        logger.warning(str(e))
+        return service_unavailable().to_response()
+    except RequestCancelledError as e:
+        logger.info(f"OpenAI generation cancelled: {e.reason}")
+        return client_closed_request().to_response()
     except ValueError as e:
         logger.error(f"Value error: {str(e)}")
         return bad_request().to_response()
@@ -203,9 +359,16 @@ def generate_anthropic_response():
     {
         "model": "model-id",
         "prompt": "User prompt text",
-        "system_prompt": "Optional system instructions" (optional)
+        "system_prompt": "Optional system instructions" (optional),
+        "document_id": "ID returned by /api/documents" (optional),
+        "priority": "interactive" | "default" | "bulk" (optional, or X-Priority header)
     }
     
+    To be able to cancel the request while it runs, send an X-Request-ID header
+    and pass that ID to /api/requests/<request_id>/cancel. The response only
+    arrives once generation ends, so the `request_id` it echoes is too late to
+    cancel with.
+    
     Returns:
         JSON response with the generated text
     """
@@ -229,16 +392,34 @@ def generate_anthropic_response():
         model_id = data["model"]
         prompt = data["prompt"]
         system_prompt = data.get("system_prompt", "")
+        document = load_document(data)
+        priority = get_priority(data)
         
         logger.info(f"Generating response using Anthropic model: {model_id}")
         if system_prompt:
             logger.info("System prompt provided")
         
+        # Register the request so a disconnect or cancel call aborts it upstream
+        request_id, cancel_token = request_registry.register(get_request_id())
+        watch_for_disconnect(request.environ, cancel_token)
+        
         # Set the model and generate response
-        anthropic_manager.set_model(model_id)
-        response_text = anthropic_manager.generate_response(prompt, system_prompt)
+        try:
+            anthropic_manager.set_model(model_id)
+            result = provider_schedulers["anthropic"].run(
+                lambda: anthropic_manager.generate(
+                    prompt, system_prompt, get_client_key(), model=model_id,
+                    cancel_token=cancel_token, document=document
+                ),
+                priority,
+                cancel_token,
+                first_token_latency
+            )
+        finally:
+            request_registry.unregister(request_id)
         
         # Ensure the response is a string
+        response_text = result.text
         if not isinstance(response_text, str):
             response_text = str(response_text)
         
@@ -246,9 +427,19 @@ def generate_anthropic_response():
         return create_success_response({
             "response": response_text,
             "model": model_id,
-            "provider": "anthropic"
+            "provider": "anthropic",
+            "request_id": request_id
         }).to_response()
         
+    except DocumentNotFoundError as e:
+        logger.warning(str(e))
+        return not_found().to_response()
+    except SchedulerOverloadedError as e:
+        logger.warning(str(e))
+        return service_unavailable().to_response()
+    except RequestCancelledError as e:
+        logger.info(f"Anthropic generation cancelled: {e.reason}")
+        return client_closed_request().to_response()
     except ValueError as e:
         logger.error(f"Value error: {str(e)}")
         return bad_request().to_response()
@@ -256,6 +447,304 @@ def generate_anthropic_response():
         logger.error(f"Error generating response: {str(e)}")
         return internal_server_error().to_response()
 
+@app.route('/api/documents', methods=['POST'])
+def upload_document():
+    """
+    Endpoint to upload a large document once and reference it by ID.
+    
+    The raw request body is the document (UTF-8 text). It is streamed to disk
+    in chunks, so large documents never sit in memory whole. An optional
+    X-Filename header records the original file name. Uploading the same
+    content twice returns the same ID.
+    
+    Returns:
+        JSON response with the document ID and size
+    """
+    logger.info("Document upload requested")
+    if request.content_length is not None and request.content_length > document_store.max_bytes:
+        logger.warning(f"Document too large: {request.content_length} bytes")
+        return payload_too_large(f"Documents are limited to {document_store.max_bytes} bytes").to_response()
+    
+    try:
+        info = document_store.save(
+            request.stream,
+            filename=request.headers.get("X-Filename", ""),
+            content_type=request.content_type or ""
+        )
+        return create_success_response(asdict(info), 201).to_response()
+    except DocumentTooLargeError as e:
+        logger.warning(str(e))
+        return payload_too_large(f"Documents are limited to {document_store.max_bytes} bytes").to_response()
+    except (EmptyDocumentError, InvalidDocumentEncodingError) as e:
+        logger.warning(str(e))
+        return bad_request(str(e)).to_response()
+    except Exception as e:
+        logger.error(f"Error storing document: {str(e)}")
+        return internal_server_error().to_response()
+
+@app.route('/api/documents/<document_id>', methods=['GET'])
+def get_document(document_id):
+    """
+    Endpoint to look up the metadata of an uploaded document.
+    
+    Returns:
+        JSON response with the document ID, size, file name and content type
+    """
+    try:
+        return create_success_response(asdict(document_store.get_info(document_id))).to_response()
+    except DocumentNotFoundError:
+        return not_found().to_response()
+
+@app.route('/api/compare', methods=['POST'])
+def compare_models():
+    """
+    Endpoint to run one prompt against several models concurrently.
+    
+    Expected JSON body:
+    {
+        "prompt": "User prompt text",
+        "system_prompt": "Optional system instructions" (optional),
+        "document_id": "ID returned by /api/documents" (optional),
+        "priority": "interactive" | "default" | "bulk" (optional, or X-Priority header),
+        "targets": [
+            {"provider": "openai", "model": "model-id"},
+            {"provider": "anthropic", "model": "model-id"}
+        ]
+    }
+    
+    Returns:
+        A newline-delimited JSON stream with one line per target, emitted as
+        soon as that target finishes, followed by a final "done" line
+    """
+    logger.info("Model comparison requested")
+    data = request.get_json(silent=True)
+    
+    if not data or "prompt" not in data or not isinstance(data.get("targets"), list):
+        logger.warning("Missing prompt or targets")
+        return bad_request().to_response()
+    
+    targets = data["targets"]
+    if not targets or len(targets) > MAX_COMPARE_TARGETS:
+        logger.warning(f"Invalid number of compare targets: {len(targets)}")
+        return bad_request(f"Between 1 and {MAX_COMPARE_TARGETS} targets are required").to_response()
+    
+    for target in targets:
+        if not isinstance(target, dict) or target.get("provider") not in model_managers or not target.get("model"):
+            logger.warning(f"Invalid compare target: {target}")
+            return bad_request("Each target needs a known provider and a model").to_response()
+    
+    prompt = data["prompt"]
+    system_prompt = data.get("system_prompt", "")
+    client_key = get_client_key()
+    
+    try:
+        document = load_document(data)
+        priority = get_priority(data)
+    except DocumentNotFoundError as e:
+        logger.warning(str(e))
+        return not_found().to_response()
+    except ValueError as e:
+        logger.warning(f"Value error: {str(e)}")
+        return bad_request().to_response()
+    
+    # One cancellation token covers every target in the comparison
+    try:
+        request_id, cancel_token = request_registry.register(get_request_id())
+    except ValueError as e:
+        logger.warning(f"Value error: {str(e)}")
+        return bad_request().to_response()
+    watch_for_disconnect(request.environ, cancel_token)
+    
+    def run_target(target: dict) -> dict:
+        """Generate a response for one target and format it as a stream line."""
+        manager = model_managers[target["provider"]]
+        result = provider_schedulers[target["provider"]].run(
+            lambda: manager.generate(prompt, system_prompt, client_key, target["model"], cancel_token, document),
+            priority,
+            cancel_token,
+            first_token_latency
+        )
+        return {
+            "type": "result",
+            "provider": result.provider,
+            "model": result.model,
+            "response": result.text,
+            "latency_ms": result.latency_ms,
+            "input_tokens": result.input_tokens,
+            "output_tokens": result.output_tokens,
+            "cached_tokens": result.cached_tokens
+        }
+    
+    start_time = time.perf_counter()
+    futures = {
+        compare_executors[(target["provider"], priority)].submit(run_target, target): target
+        for target in targets
+    }
+    
+    def stream_results():
+        for future in as_completed(futures):
+            target = futures[future]
+            try:
+                line = future.result()
+            except RequestCancelledError:
+                line = {"type": "cancelled", "provider": target["provider"], "model": target["model"]}
+            except SchedulerOverloadedError as e:
+                logger.warning(str(e))
+                line = {
+                    "type": "error",
+                    "provider": target["provider"],
+                    "model": target["model"],
+                    "message": ErrorMessages.SERVICE_UNAVAILABLE
+                }
+            except Exception as e:
+                logger.error(f"Error comparing {target['provider']}/{target['model']}: {str(e)}")
+                line = {
+                    "type": "error",
+                    "provider": target["provider"],
+                    "model": target["model"],
+                    "message": ErrorMessages.INTERNAL_SERVER_ERROR
+                }
+            yield json.dumps(line) + "\n"
+        
+        total_latency_ms = (time.perf_counter() - start_time) * 1000
+        logger.info(f"Compared {len(targets)} models in {total_latency_ms:.0f} ms")
+        yield json.dumps({"type": "done", "request_id": request_id, "total_latency_ms": total_latency_ms}) + "\n"
+    
+    def finish_comparison():
+        """Abort unfinished targets if the client went away, then release the request."""
+        if not all(future.done() for future in futures):
+            cancel_token.cancel(REASON_CLIENT_DISCONNECT)
+            for future in futures:
+                future.cancel()
+        request_registry.unregister(request_id)
+    
+    response = Response(stream_results(), mimetype="application/x-ndjson")
+    response.headers["X-Request-ID"] = request_id
+    response.call_on_close(finish_comparison)
+    return response
+
+@sock.route('/api/ws/chat')
+def chat_socket(ws):
+    """
+    WebSocket endpoint for chat over one persistent connection.
+    
+    Clients send generate/cancel messages and receive streamed tokens for any
+    number of concurrent generations. See src.sockets.chat_socket for the protocol.
+    """
+    logger.info("Chat socket opened")
+    ChatSocketSession(
+        ws, model_managers, request_registry, get_client_key(), document_store, provider_schedulers
+    ).run()
+    logger.info("Chat socket closed")
+
+@app.route('/api/requests/<request_id>/cancel', methods=['POST'])
+def cancel_request(request_id):
+    """
+    Endpoint to cancel an in-flight generation by its request ID.
+    
+    The upstream provider request is aborted and the original request
+    returns 499 Client Closed Request.
+    
+    Returns:
+        JSON response confirming the cancellation, or 404 if no such request is running
+    """
+    logger.info(f"Cancellation requested for request '{request_id}'")
+    if not request_registry.cancel(request_id):
+        return not_found().to_response()
+    return create_success_response({"request_id": request_id, "cancelled": True}).to_response()
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """
+    Endpoint exposing request counters for monitoring.
+    
+    Returns:
+        JSON response with in-flight, completed and cancelled request counts,
+        and each provider scheduler's concurrency limit and queue depths
+    """
+    return create_success_response({
+        "requests": request_registry.metrics(),
+        "schedulers": {provider: scheduler.stats() for provider, scheduler in provider_schedulers.items()}
+    }).to_response()
+
+def parse_time_range() -> tuple:
+    """
+    Parse the optional `since` and `until` query parameters (unix timestamps).
+    
+    Raises:
+        ValueError: If either parameter is not a number
+    """
+    since = request.args.get("since")
+    until = request.args.get("until")
+    return (float(since) if since else None, float(until) if until else None)
+
+@app.route('/api/usage/keys', methods=['GET'])
+def usage_by_key():
+    """
+    Endpoint to aggregate token usage and cost per client key.
+    
+    Optional query parameters: since, until (unix timestamps)
+    
+    Returns:
+        JSON response with one aggregate per client key
+    """
+    logger.info("Usage by key requested")
+    try:
+        since, until = parse_time_range()
+        return create_success_response(usage_ledger.usage_by_key(since, until)).to_response()
+    except ValueError as e:
+        logger.error(f"Value error: {str(e)}")
+        return bad_request().to_response()
+    except Exception as e:
+        logger.error(f"Error aggregating usage: {str(e)}")
+        return internal_server_error().to_response()
+
+@app.route('/api/usage/models', methods=['GET'])
+def usage_by_model():
+    """
+    Endpoint to aggregate token usage and cost per provider and model.
+    
+    Optional query parameters: since, until (unix timestamps)
+    
+    Returns:
+        JSON response with one aggregate per model
+    """
+    logger.info("Usage by model requested")
+    try:
+        since, until = parse_time_range()
+        return create_success_response(usage_ledger.usage_by_model(since, until)).to_response()
+    except ValueError as e:
+        logger.error(f"Value error: {str(e)}")
+        return bad_request().to_response()
+    except Exception as e:
+        logger.error(f"Error aggregating usage: {str(e)}")
+        return internal_server_error().to_response()
+
+@app.route('/api/usage/timeseries', methods=['GET'])
+def usage_by_time():
+    """
+    Endpoint to aggregate token usage and cost per time bucket.
+    
+    Optional query parameters: bucket (seconds, default 3600), since, until.
+    Buckets that are not whole hours require since and until, at most a day apart.
+    
+    Returns:
+        JSON response with one aggregate per bucket
+    """
+    logger.info("Usage timeseries requested")
+    try:
+        since, until = parse_time_range()
+        bucket_seconds = int(request.args.get("bucket", 3600))
+        return create_success_response(
+            usage_ledger.usage_by_time(bucket_seconds, since, until)
+        ).to_response()
+    except ValueError as e:
+        logger.error(f"Value error: {str(e)}")
+        return bad_request(str(e)).to_response()
+    except Exception as e:
+        logger.error(f"Error aggregating usage: {str(e)}")
+        return internal_server_error().to_response()
+
 # Global error handlers
 @app.errorhandler(404)
 def handle_not_found(e):
@@ -273,7 +762,6 @@ def handle_server_error(e):
 if __name__ == '__main__':
     logger.info("Starting Flask application")
     # Disable the debugger pin for development
-    import os
     os.environ['WERKZEUG_DEBUG_PIN'] = 'off'
     # Use port 8000 instead of 5000 (which is often used by AirPlay on macOS)
     app.run(debug=True, host='0.0.0.0', port=8000)
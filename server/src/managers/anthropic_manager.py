@@ -9,10 +9,14 @@ Date: March 2025
 """
 
 import logging
-from typing import Optional, List, Dict, Any
+import time
+from typing import Optional, List, Dict, Any, Iterator
 
 import anthropic
-from src.managers.base_manager import BaseManager
+from src.cancellation.registry import CancellationToken
+from src.documents.store import DocumentContent
+from src.managers.base_manager import BaseManager, GenerationResult
+from src.transport.http_client import get_shared_http_client, get_transport_config
 
 # Configure module logger
 logger = logging.getLogger(__name__)
@@ -41,7 +45,13 @@ class AnthropicManager(BaseManager):
         if not api_key:
             logger.warning("No Anthropic API key found in environment variables")
             
-        self.client = anthropic.Anthropic(api_key=api_key)
+        # Use the shared, tuned HTTP client so connections are pooled and kept warm
+        transport_config = get_transport_config()
+        self.client = anthropic.Anthropic(
+            api_key=api_key,
+            base_url=transport_config.anthropic_base_url,
+            http_client=get_shared_http_client()
+        )
         
         # Initialize model tracking
         self.model = None
@@ -49,34 +59,96 @@ class AnthropicManager(BaseManager):
         
         logger.info("AnthropicManager initialized successfully")
     
-    def generate_response(self, prompt: str, system_prompt: str = "") -> str:
+    def generate(self, prompt: str, system_prompt: str = "", client_key: str = "",
+                 model: Optional[str] = None,
+                 cancel_token: Optional[CancellationToken] = None,
+                 document: Optional[DocumentContent] = None) -> GenerationResult:
         """
         Generate a response using the Anthropic API.
         
         Args:
             prompt: The user's input prompt
             system_prompt: Optional system instructions for the model
+            client_key: Identifier of the calling client, used for usage accounting
+            model: Model to use for this call (defaults to the active model)
+            cancel_token: Cancels the upstream request when triggered
+            document: Stored document the prompt asks about (optional)
         
         Returns:
-            The generated text response
+            The generated text along with its usage
         
         Raises:
             ValueError: If no model has been set
+            RequestCancelledError: If the request was cancelled
         """
+        # Cancellable requests are streamed so they can be aborted mid-generation
+        if cancel_token is not None:
+            return self._generate_cancellable(prompt, system_prompt, client_key, model, cancel_token, document)
+        
         # Validate that a model has been selected
-        if self.model is None:
+        try:
+            model = self._resolve_model(model)
+        except ValueError:
             logger.error("Cannot generate response: Model is not set")
-            raise ValueError("Model is not set")
+            raise
         
         # Call the Anthropic API to generate a response
-        logger.info(f"Generating response with model '{self.model}'")
+        logger.info(f"Generating response with model '{model}'")
+        request_params = self._build_request_params(prompt, system_prompt, model, document)
         
+        # Make the API call
+        start_time = time.perf_counter()
+        response = self.client.messages.create(**request_params)
+        latency_ms = (time.perf_counter() - start_time) * 1000
+        logger.info(f"Response received from Anthropic API")
+        
+        result = GenerationResult(
+            text=self._extract_text(response),
+            provider=self.provider,
+            model=model,
+            latency_ms=latency_ms
+        )
+        self._apply_usage(response, result)
+        self._record_usage(result, client_key)
+        return result
+
+    def _stream_chunks(self, prompt: str, system_prompt: str, model: str, result: GenerationResult,
+                       cancel_token: Optional[CancellationToken] = None,
+                       document: Optional[DocumentContent] = None) -> Iterator[str]:
+        """Stream a response from the Anthropic API, yielding text deltas."""
+        logger.info(f"Streaming response with model '{model}'")
+        request_params = self._build_request_params(prompt, system_prompt, model, document)
+        
+        # Leaving the context manager (including via GeneratorExit) closes the HTTP stream
+        with self.client.messages.stream(**request_params) as stream:
+            if cancel_token is not None:
+                cancel_token.add_callback(stream.close)
+            for text in stream.text_stream:
+                yield text
+            message = stream.get_final_message()
+        
+        logger.info(f"Stream completed from Anthropic API")
+        self._apply_usage(message, result)
+
+    def _build_request_params(self, prompt: str, system_prompt: str, model: str,
+                              document: Optional[DocumentContent] = None) -> Dict[str, Any]:
+        """Build the Messages API request parameters for a prompt."""
         # Prepare the messages array
-        messages = [{"role": "user", "content": prompt}]
+        if document is None:
+            messages = [{"role": "user", "content": prompt}]
+        else:
+            # The document goes in its own block, ahead of the question and marked
+            # for prompt caching, so follow-up questions reuse the cached prefix
+            # instead of paying for the whole document again
+            logger.info(f"Including document '{document.id}' in request")
+            messages = [{"role": "user", "content": [
+                {"type": "text", "text": document.text, "cache_control": {"type": "ephemeral"}},
+                {"type": "text", "text": prompt}
+            ]}]
         
         # Prepare the request parameters
         request_params = {
-            "model": self.model,
+            "model": model,
             "max_tokens": 1024,
             "messages": messages
         }
@@ -86,11 +158,10 @@ class AnthropicManager(BaseManager):
             logger.info("Including system prompt in request")
             request_params["system"] = system_prompt
         
-        # Make the API call
-        response = self.client.messages.create(**request_params)
-        logger.info(f"Response received from Anthropic API")
-        
-        # Extract the text content from the response
+        return request_params
+
+    def _extract_text(self, response: Any) -> str:
+        """Extract the text content from an Anthropic response."""
         # The Anthropic API returns content as a list of content blocks
         if response.content and len(response.content) > 0:
             # Get the first content block (usually there's just one)
@@ -101,6 +172,25 @@ class AnthropicManager(BaseManager):
         # If we couldn't extract text through the expected path, return a fallback
         return "Response received but could not extract text content."
 
+    def _apply_usage(self, response: Any, result: GenerationResult) -> None:
+        """
+        Copy the token usage reported in an Anthropic response onto the result.
+        
+        Anthropic reports cache reads and writes separately from input_tokens,
+        so they are folded back in to get the total input size. Cache writes
+        are also kept apart because they are billed at a premium.
+        """
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        
+        cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+        cache_creation = getattr(usage, "cache_creation_input_tokens", None) or 0
+        result.input_tokens = (usage.input_tokens or 0) + cache_read + cache_creation
+        result.output_tokens = usage.output_tokens or 0
+        result.cached_tokens = cache_read
+        result.cache_write_tokens = cache_creation
+
     def list_models(self) -> List[Dict[str, Any]]:
         """
         List all available models from the Anthropic API.
@@ -9,13 +9,67 @@ Date: March 2025
 """
 
 import os
+import time
 from abc import ABC, abstractmethod
-from typing import Any, Optional, List, Dict
+from dataclasses import dataclass
+from typing import Any, Optional, List, Dict, Iterator
 from dotenv import load_dotenv
 
+from src.cancellation.registry import CancellationToken
+from src.documents.store import DocumentContent
+from src.errors.exceptions import RequestCancelledError
+from src.usage.ledger import (
+    STATUS_CANCELLED, STATUS_COMPLETED, STATUS_FAILED, UsageLedger, create_usage_record
+)
+
 # Load environment variables from .env file
 load_dotenv()
 
+# Rough characters-per-token ratio used when the provider never reported usage
+CHARS_PER_TOKEN = 4
+
+def estimate_tokens(*texts: str) -> int:
+    """Estimate the token count of some text from its length."""
+    return sum(len(text) for text in texts if text) // CHARS_PER_TOKEN
+
+@dataclass
+class GenerationResult:
+    """The text and usage of a single generated response."""
+    text: str
+    provider: str
+    model: str
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_tokens: int = 0
+    cache_write_tokens: int = 0
+    latency_ms: float = 0.0
+    # Time until the provider sent the first text, unaffected by how fast the caller reads
+    first_token_ms: Optional[float] = None
+    status: str = STATUS_COMPLETED
+
+def first_token_latency(result: GenerationResult) -> Optional[float]:
+    """Latency signal used to adapt provider concurrency: the time to first token."""
+    return result.first_token_ms
+
+class GenerationStream:
+    """
+    Iterator over the text deltas of a streamed response.
+    
+    Once the stream is exhausted, `result` holds the full text and usage.
+    Closing the stream early aborts the upstream request.
+    """
+    
+    def __init__(self, chunks: Iterator[str], result: GenerationResult):
+        self._chunks = chunks
+        self.result = result
+    
+    def __iter__(self) -> Iterator[str]:
+        return self._chunks
+    
+    def close(self) -> None:
+        """Stop the stream and release the upstream connection."""
+        self._chunks.close()
+
 class BaseManager(ABC):
     """
     Abstract base class for AI model provider managers.
@@ -35,6 +89,7 @@ class BaseManager(ABC):
         self.provider = provider
         self.model = None
         self.model_display_name = None
+        self.usage_ledger: Optional[UsageLedger] = None
     
     def __str__(self) -> str:
         """Return a string representation of the manager."""
@@ -53,20 +108,205 @@ class BaseManager(ABC):
             return os.getenv("ANTHROPIC_KEY")
         return None
 
+    def set_usage_ledger(self, usage_ledger: Optional[UsageLedger]) -> None:
+        """
+        Attach a usage ledger that records token usage for each request.
+        
+        Args:
+            usage_ledger: The ledger to record into, or None to disable recording
+        """
+        self.usage_ledger = usage_ledger
+
+    def _resolve_model(self, model: Optional[str] = None) -> str:
+        """
+        Pick the model for a request: the explicit one if given, else the active one.
+        
+        Raises:
+            ValueError: If no model was given and none has been set
+        """
+        model = model or self.model
+        if model is None:
+            raise ValueError("Model is not set")
+        return model
+
+    def _record_usage(self, result: GenerationResult, client_key: str) -> None:
+        """
+        Record the usage of a request in the attached ledger, if any.
+        
+        Args:
+            result: The finished, cancelled or failed generation
+            client_key: Identifier of the client that made the request
+        """
+        if self.usage_ledger is None:
+            return
+        self.usage_ledger.record(create_usage_record(
+            client_key, result.provider, result.model, result.input_tokens,
+            result.output_tokens, result.cached_tokens, result.latency_ms,
+            cache_write_tokens=result.cache_write_tokens, status=result.status
+        ))
+
     @abstractmethod
-    def generate_response(self, prompt: str) -> Any:
+    def generate(self, prompt: str, system_prompt: str = "", client_key: str = "",
+                 model: Optional[str] = None,
+                 cancel_token: Optional[CancellationToken] = None,
+                 document: Optional[DocumentContent] = None) -> GenerationResult:
+        """
+        Generate a response and report its token usage and latency.
+        
+        Passing `model` uses that model for this call only, without touching
+        the active model, so one manager can serve concurrent requests for
+        different models.
+        
+        Args:
+            prompt: The user's input prompt
+            system_prompt: Optional system instructions for the model
+            client_key: Identifier of the calling client, used for usage accounting
+            model: Model to use for this call (defaults to the active model)
+            cancel_token: Cancels the upstream request when triggered
+            document: Stored document the prompt asks about (optional)
+            
+        Returns:
+            The generated text along with its usage
+            
+        Raises:
+            ValueError: If no model was given and none has been set
+            RequestCancelledError: If the request was cancelled
+        """
+        pass
+
+    def _generate_cancellable(self, prompt: str, system_prompt: str, client_key: str,
+                              model: Optional[str], cancel_token: CancellationToken,
+                              document: Optional[DocumentContent] = None) -> GenerationResult:
+        """
+        Generate a response over a stream so it can be aborted part-way.
+        
+        A non-streamed call only returns once the whole response is ready and
+        cannot be interrupted, so cancellable requests are streamed and
+        collected instead.
+        """
+        stream = self.stream(prompt, system_prompt, client_key, model, cancel_token, document)
+        try:
+            for _ in stream:
+                pass
+        finally:
+            stream.close()
+        return stream.result
+
+    def generate_response(self, prompt: str, system_prompt: str = "", client_key: str = "") -> str:
         """
         Generate a response using the selected model.
         
         Args:
             prompt: The user's input prompt
+            system_prompt: Optional system instructions for the model
+            client_key: Identifier of the calling client, used for usage accounting
             
         Returns:
-            The generated response (format may vary by provider)
+            The generated text response
             
         Raises:
             ValueError: If no model has been set
         """
+        return self.generate(prompt, system_prompt, client_key).text
+
+    def stream(self, prompt: str, system_prompt: str = "", client_key: str = "",
+               model: Optional[str] = None,
+               cancel_token: Optional[CancellationToken] = None,
+               document: Optional[DocumentContent] = None) -> GenerationStream:
+        """
+        Generate a response and stream its text as it is produced.
+        
+        Args:
+            prompt: The user's input prompt
+            system_prompt: Optional system instructions for the model
+            client_key: Identifier of the calling client, used for usage accounting
+            model: Model to use for this call (defaults to the active model)
+            cancel_token: Closes the upstream stream when triggered
+            document: Stored document the prompt asks about (optional)
+            
+        Returns:
+            A stream of text deltas; its result is complete once it is exhausted
+            
+        Raises:
+            ValueError: If no model was given and none has been set
+            RequestCancelledError: While iterating, if the request was cancelled
+        """
+        model = self._resolve_model(model)
+        result = GenerationResult(text="", provider=self.provider, model=model)
+        chunks = self._stream_chunks(prompt, system_prompt, model, result, cancel_token, document)
+        estimated_input_tokens = estimate_tokens(prompt, system_prompt, document.text if document else "")
+        return GenerationStream(
+            self._track_stream(chunks, result, client_key, cancel_token, estimated_input_tokens), result
+        )
+
+    def _track_stream(self, chunks: Iterator[str], result: GenerationResult, client_key: str,
+                      cancel_token: Optional[CancellationToken] = None,
+                      estimated_input_tokens: int = 0) -> Iterator[str]:
+        """
+        Pass deltas through while collecting the text, then record usage.
+        
+        Usage is recorded however the stream ends. A cancelled or failed stream
+        has usually been billed for its input and partial output, but the
+        provider only reports usage at the end, so missing counts are estimated.
+        """
+        start_time = time.perf_counter()
+        parts = []
+        started = False
+        status = STATUS_FAILED
+        try:
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
+            started = True
+            for text in chunks:
+                if not parts:
+                    result.first_token_ms = (time.perf_counter() - start_time) * 1000
+                parts.append(text)
+                yield text
+                if cancel_token is not None:
+                    cancel_token.raise_if_cancelled()
+            status = STATUS_COMPLETED
+        except RequestCancelledError:
+            status = STATUS_CANCELLED
+            raise
+        except GeneratorExit:
+            # The consumer closed the stream before it finished
+            status = STATUS_CANCELLED
+            raise
+        except Exception:
+            # Aborting the upstream stream surfaces as a transport error in the
+            # reading thread; report it as the cancellation it really is
+            if cancel_token is not None and cancel_token.cancelled:
+                status = STATUS_CANCELLED
+                raise RequestCancelledError(cancel_token.reason or "cancelled") from None
+            raise
+        finally:
+            # Closing this generator must also close the provider stream
+            chunks.close()
+            
+            result.text = "".join(parts)
+            result.latency_ms = (time.perf_counter() - start_time) * 1000
+            if cancel_token is not None and cancel_token.cancelled:
+                status = STATUS_CANCELLED
+            result.status = status
+            # Nothing reached the provider if the request was cancelled before it started
+            if started:
+                # A provider error before any output is generally not billed
+                if status == STATUS_CANCELLED or (status == STATUS_FAILED and parts):
+                    result.input_tokens = result.input_tokens or estimated_input_tokens
+                    result.output_tokens = result.output_tokens or estimate_tokens(result.text)
+                self._record_usage(result, client_key)
+
+    @abstractmethod
+    def _stream_chunks(self, prompt: str, system_prompt: str, model: str, result: GenerationResult,
+                       cancel_token: Optional[CancellationToken] = None,
+                       document: Optional[DocumentContent] = None) -> Iterator[str]:
+        """
+        Stream a response from the provider, yielding text deltas.
+        
+        Implementations fill in the token usage on `result` when the provider
+        reports it at the end of the stream, and register a callback on
+        `cancel_token` that closes the provider stream.
+        """
         pass
 
     @abstractmethod
@@ -9,10 +9,14 @@ Date: March 2025
 """
 
 import logging
-from typing import Optional, List, Dict, Any
+import time
+from typing import Optional, List, Dict, Any, Iterator
 
 from openai import OpenAI
-from src.managers.base_manager import BaseManager
+from src.cancellation.registry import CancellationToken
+from src.documents.store import DocumentContent
+from src.managers.base_manager import BaseManager, GenerationResult
+from src.transport.http_client import get_shared_http_client, get_transport_config
 
 # Configure module logger
 logger = logging.getLogger(__name__)
@@ -41,7 +45,13 @@ class OpenAIManager(BaseManager):
         if not api_key:
             logger.warning("No OpenAI API key found in environment variables")
             
-        self.client = OpenAI(api_key=api_key)
+        # Use the shared, tuned HTTP client so connections are pooled and kept warm
+        transport_config = get_transport_config()
+        self.client = OpenAI(
+            api_key=api_key,
+            base_url=transport_config.openai_base_url,
+            http_client=get_shared_http_client()
+        )
         
         # Initialize model tracking
         self.model = None
@@ -49,46 +59,124 @@ class OpenAIManager(BaseManager):
         
         logger.info("OpenAIManager initialized successfully")
     
-    def generate_response(self, prompt: str, system_prompt: str = "") -> str:
+    def generate(self, prompt: str, system_prompt: str = "", client_key: str = "",
+                 model: Optional[str] = None,
+                 cancel_token: Optional[CancellationToken] = None,
+                 document: Optional[DocumentContent] = None) -> GenerationResult:
         """
         Generate a response using the OpenAI API.
         
         Args:
             prompt: The user's input prompt
             system_prompt: Optional system instructions for the model
+            client_key: Identifier of the calling client, used for usage accounting
+            model: Model to use for this call (defaults to the active model)
+            cancel_token: Cancels the upstream request when triggered
+            document: Stored document the prompt asks about (optional)
             
         Returns:
-            The generated text response
+            The generated text along with its usage
             
         Raises:
             ValueError: If no model has been set
+            RequestCancelledError: If the request was cancelled
         """
+        # Cancellable requests are streamed so they can be aborted mid-generation
+        if cancel_token is not None:
+            return self._generate_cancellable(prompt, system_prompt, client_key, model, cancel_token, document)
+        
         # Validate that a model has been selected
-        if self.model is None:
+        try:
+            model = self._resolve_model(model)
+        except ValueError:
             logger.error("Cannot generate response: Model is not set")
-            raise ValueError("Model is not set")
+            raise
             
         # Call the OpenAI API to generate a response
-        logger.info(f"Generating response with model '{self.model}'")
+        logger.info(f"Generating response with model '{model}'")
+        request_params = self._build_request_params(prompt, system_prompt, model, document)
+        
+        # Make the API call
+        start_time = time.perf_counter()
+        response = self.client.responses.create(**request_params)
+        latency_ms = (time.perf_counter() - start_time) * 1000
+        logger.info(f"Response received from OpenAI API")
         
+        # The OpenAI API provides the response text in the output_text property
+        result = GenerationResult(
+            text=response.output_text,
+            provider=self.provider,
+            model=model,
+            latency_ms=latency_ms
+        )
+        self._apply_usage(response, result)
+        self._record_usage(result, client_key)
+        return result
+
+    def _stream_chunks(self, prompt: str, system_prompt: str, model: str, result: GenerationResult,
+                       cancel_token: Optional[CancellationToken] = None,
+                       document: Optional[DocumentContent] = None) -> Iterator[str]:
+        """Stream a response from the OpenAI API, yielding text deltas."""
+        logger.info(f"Streaming response with model '{model}'")
+        request_params = self._build_request_params(prompt, system_prompt, model, document)
+        
+        stream = self.client.responses.create(**request_params, stream=True)
+        if cancel_token is not None:
+            cancel_token.add_callback(stream.close)
+        try:
+            for event in stream:
+                if event.type == "response.output_text.delta":
+                    yield event.delta
+                elif event.type == "response.completed":
+                    self._apply_usage(event.response, result)
+        finally:
+            # Release the HTTP connection, including when the caller stops early
+            stream.close()
+        
+        logger.info(f"Stream completed from OpenAI API")
+
+    def _build_request_params(self, prompt: str, system_prompt: str, model: str,
+                              document: Optional[DocumentContent] = None) -> Dict[str, Any]:
+        """Build the Responses API request parameters for a prompt."""
         # Prepare the request parameters
         request_params = {
-            "model": self.model,
+            "model": model,
             "input": prompt
         }
         
+        if document is not None:
+            # OpenAI caches identical prompt prefixes automatically, so the
+            # document goes first and the question last; the cache key routes
+            # repeat questions about one document to the same cache
+            logger.info(f"Including document '{document.id}' in request")
+            request_params["input"] = [{"role": "user", "content": [
+                {"type": "input_text", "text": document.text},
+                {"type": "input_text", "text": prompt}
+            ]}]
+            request_params["prompt_cache_key"] = f"doc-{document.id[:32]}"
+        
         # Add system prompt if provided
         if system_prompt:
             logger.info("Including system prompt in request")
             request_params["instructions"] = system_prompt
         
-        # Make the API call
-        response = self.client.responses.create(**request_params)
-        logger.info(f"Response received from OpenAI API")
+        return request_params
+
+    def _apply_usage(self, response: Any, result: GenerationResult) -> None:
+        """
+        Copy the token usage reported in an OpenAI response onto the result.
         
-        # Extract and return the text content
-        # The OpenAI API provides the response text in the output_text property
-        return response.output_text
+        OpenAI includes cached tokens in input_tokens and reports them again
+        under input_tokens_details.
+        """
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        
+        details = getattr(usage, "input_tokens_details", None)
+        result.input_tokens = usage.input_tokens or 0
+        result.output_tokens = usage.output_tokens or 0
+        result.cached_tokens = (getattr(details, "cached_tokens", None) or 0) if details else 0
 
     def list_models(self) -> List[Dict[str, Any]]:
         """
@@ -12,13 +12,19 @@ class ErrorCodes:
     BAD_REQUEST = 400
     UNAUTHORIZED = 401
     NOT_FOUND = 404
+    PAYLOAD_TOO_LARGE = 413
+    CLIENT_CLOSED_REQUEST = 499
     INTERNAL_SERVER_ERROR = 500
+    SERVICE_UNAVAILABLE = 503
 
 class ErrorMessages:
     BAD_REQUEST = "Bad Request"
     UNAUTHORIZED = "Unauthorized"
     NOT_FOUND = "Not Found"
+    PAYLOAD_TOO_LARGE = "Payload Too Large"
+    CLIENT_CLOSED_REQUEST = "Client Closed Request"
     INTERNAL_SERVER_ERROR = "Internal Server Error"
+    SERVICE_UNAVAILABLE = "Service Unavailable"
 
 class ErrorResponse:
     def __init__(self, code: int, message: str, details: Optional[Any] = None):
@@ -77,6 +83,18 @@ def not_found(details: Optional[Any] = None) -> ErrorResponse:
     """Create a 404 Not Found error response."""
     return create_error_response(ErrorCodes.NOT_FOUND, ErrorMessages.NOT_FOUND, details)
 
+def payload_too_large(details: Optional[Any] = None) -> ErrorResponse:
+    """Create a 413 Payload Too Large error response."""
+    return create_error_response(ErrorCodes.PAYLOAD_TOO_LARGE, ErrorMessages.PAYLOAD_TOO_LARGE, details)
+
+def client_closed_request(details: Optional[Any] = None) -> ErrorResponse:
+    """Create a 499 Client Closed Request error response for cancelled requests."""
+    return create_error_response(ErrorCodes.CLIENT_CLOSED_REQUEST, ErrorMessages.CLIENT_CLOSED_REQUEST, details)
+
 def internal_server_error(details: Optional[Any] = None) -> ErrorResponse:
     """Create a 500 Internal Server Error response."""
     return create_error_response(ErrorCodes.INTERNAL_SERVER_ERROR, ErrorMessages.INTERNAL_SERVER_ERROR, details)
+
+def service_unavailable(details: Optional[Any] = None) -> ErrorResponse:
+    """Create a 503 Service Unavailable error response."""
+    return create_error_response(ErrorCodes.SERVICE_UNAVAILABLE, ErrorMessages.SERVICE_UNAVAILABLE, details)
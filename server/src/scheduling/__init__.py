@@ -0,0 +1,3 @@
+"""
+Scheduling package
+"""
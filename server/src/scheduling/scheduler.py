@@ -0,0 +1,306 @@
+"""
+Provider Scheduler
+
+This module admits requests to a provider through a per-provider scheduler.
+Interactive chat traffic is therefore not starved by bulk jobs, and the number
+of concurrent upstream calls follows what the provider can actually sustain.
+
+- Priority classes (interactive > default > bulk) share capacity by weighted
+  fair queuing. Stride scheduling gives each class slots in proportion to its
+  weight while it has work queued, so bulk traffic still makes progress.
+- The concurrency limit adapts AIMD-style. It grows by about one slot per
+  window of successful calls, counting only calls made while the limit was
+  actually in the way (all slots busy or requests queued), so light traffic
+  does not inflate it. It is cut in half on a 429 and by 10% when
+  recent latency rises well above the long-run average.
+
+The latency signal is each call's time to first token. It is measured on the
+provider side of the stream, so it reflects provider congestion rather than
+output length or how fast the client reads. 429s are reported by the shared
+HTTP client as they happen (see src.transport.http_client), including ones
+the SDKs go on to retry.
+
+Author: Pradyun Magal
+Date: March 2025
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Optional
+
+from src.cancellation.registry import CancellationToken
+from src.errors.exceptions import SchedulerOverloadedError
+
+# Configure module logger
+logger = logging.getLogger(__name__)
+
+# Priority classes, highest first
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_DEFAULT = "default"
+PRIORITY_BULK = "bulk"
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_DEFAULT, PRIORITY_BULK)
+
+# Share of freed slots each class gets while all classes have work queued
+PRIORITY_WEIGHTS = {
+    PRIORITY_INTERACTIVE: 8,
+    PRIORITY_DEFAULT: 4,
+    PRIORITY_BULK: 1,
+}
+
+# Multiplicative decrease factors
+THROTTLE_BACKOFF = 0.5
+LATENCY_BACKOFF = 0.9
+
+# Recent latency this many times the long-run average counts as congestion
+LATENCY_TOLERANCE = 2.0
+
+# EWMA smoothing for the recent and long-run latency averages
+SHORT_EWMA_ALPHA = 0.3
+LONG_EWMA_ALPHA = 0.05
+
+# Minimum seconds between two decreases, so one burst of 429s cuts the limit once
+DECREASE_COOLDOWN = 1.0
+
+
+class _Waiter:
+    """A queued request waiting for a slot."""
+    __slots__ = ("priority", "granted")
+
+    def __init__(self, priority: str):
+        self.priority = priority
+        self.granted = False
+
+
+class ProviderScheduler:
+    """
+    Admission control for one provider.
+
+    This class handles:
+    - Queuing requests per priority class and granting slots by weighted fair queuing
+    - Adapting the concurrency limit to observed latency and rate limiting
+    - Reporting queue depth and the current limit for monitoring
+    """
+
+    def __init__(self, provider: str, initial_limit: float = 8, min_limit: float = 1,
+                 max_limit: float = 64, max_queue: int = 1000, queue_timeout: float = 120.0):
+        """
+        Initialize the scheduler.
+
+        Args:
+            provider: Name of the provider this scheduler fronts
+            initial_limit: Starting concurrency limit
+            min_limit: Lowest the limit may shrink to
+            max_limit: Highest the limit may grow to
+            max_queue: Maximum queued requests per priority class
+            queue_timeout: Maximum seconds a request may wait for a slot
+        """
+        self.provider = provider
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self._condition = threading.Condition()
+        self._limit = float(min(max(initial_limit, min_limit), max_limit))
+        self._in_flight = 0
+        self._queues: Dict[str, Deque[_Waiter]] = {priority: deque() for priority in PRIORITIES}
+
+        # Stride scheduling state: each class advances its pass by 1/weight per grant
+        self._pass: Dict[str, float] = {priority: 0.0 for priority in PRIORITIES}
+        self._global_pass = 0.0
+
+        self._short_latency: Optional[float] = None
+        self._long_latency: Optional[float] = None
+        self._last_decrease = 0.0
+
+        self._completed = 0
+        self._throttled = 0
+        self._rejected = 0
+
+    def acquire(self, priority: str = PRIORITY_DEFAULT,
+                cancel_token: Optional[CancellationToken] = None) -> None:
+        """
+        Wait for a slot to call the provider.
+
+        Every successful acquire must be paired with a release.
+
+        Args:
+            priority: Priority class of the request
+            cancel_token: Stop waiting if the request is cancelled
+
+        Raises:
+            ValueError: If the priority class is unknown
+            SchedulerOverloadedError: If the queue is full or the wait times out
+            RequestCancelledError: If the request is cancelled while queued
+        """
+        if priority not in self._queues:
+            raise ValueError(f"Unknown priority '{priority}'")
+
+        with self._condition:
+            # Fast path: spare capacity and nobody ahead of us
+            if self._in_flight < int(self._limit) and not any(self._queues.values()):
+                self._in_flight += 1
+                return
+
+            queue = self._queues[priority]
+            if len(queue) >= self.max_queue:
+                self._rejected += 1
+                raise SchedulerOverloadedError(f"{self.provider} {priority} queue is full")
+
+            # A class that was idle rejoins at the current virtual time instead of
+            # cashing in the turns it did not use
+            if not queue:
+                self._pass[priority] = max(self._pass[priority], self._global_pass)
+
+            waiter = _Waiter(priority)
+            queue.append(waiter)
+
+        if cancel_token is not None:
+            cancel_token.add_callback(self._wake_all)
+
+        deadline = time.monotonic() + self.queue_timeout
+        with self._condition:
+            while not waiter.granted:
+                remaining = deadline - time.monotonic()
+                cancelled = cancel_token is not None and cancel_token.cancelled
+                if remaining <= 0 or cancelled:
+                    self._queues[priority].remove(waiter)
+                    if cancelled:
+                        cancel_token.raise_if_cancelled()
+                    self._rejected += 1
+                    raise SchedulerOverloadedError(f"Timed out waiting for a {self.provider} slot")
+                self._condition.wait(remaining)
+
+    def release(self, latency_ms: Optional[float] = None) -> None:
+        """
+        Return a slot and feed the call's latency into the adaptive limit.
+
+        Args:
+            latency_ms: Upstream latency of the call (None if there is no measurement)
+        """
+        with self._condition:
+            limit_bound = self._in_flight >= int(self._limit) or any(self._queues.values())
+            self._in_flight -= 1
+            if latency_ms is not None:
+                self._completed += 1
+                self._observe_latency(latency_ms, limit_bound)
+            self._dispatch()
+
+    def record_throttle(self) -> None:
+        """Register a 429 from the provider and cut the limit multiplicatively."""
+        with self._condition:
+            self._throttled += 1
+            self._decrease(THROTTLE_BACKOFF, "rate limited")
+
+    def run(self, call: Callable[[], Any], priority: str = PRIORITY_DEFAULT,
+            cancel_token: Optional[CancellationToken] = None,
+            latency_of: Optional[Callable[[Any], Optional[float]]] = None) -> Any:
+        """
+        Run a provider call inside a scheduler slot.
+
+        Args:
+            call: Function that performs the upstream request
+            priority: Priority class of the request
+            cancel_token: Stop waiting if the request is cancelled
+            latency_of: Extracts the latency signal from the call's result
+                (defaults to the call's total duration)
+
+        Returns:
+            Whatever `call` returns
+        """
+        self.acquire(priority, cancel_token)
+        start_time = time.perf_counter()
+        latency_ms = None
+        try:
+            result = call()
+            if latency_of is not None:
+                latency_ms = latency_of(result)
+            else:
+                latency_ms = (time.perf_counter() - start_time) * 1000
+            return result
+        finally:
+            self.release(latency_ms)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the current limit, queue depths and counters."""
+        with self._condition:
+            return {
+                "limit": round(self._limit, 2),
+                "in_flight": self._in_flight,
+                "queued": {priority: len(queue) for priority, queue in self._queues.items()},
+                "queued_total": sum(len(queue) for queue in self._queues.values()),
+                "latency_ms": round(self._short_latency, 1) if self._short_latency is not None else None,
+                "completed": self._completed,
+                "throttled": self._throttled,
+                "rejected": self._rejected
+            }
+
+    def _observe_latency(self, latency_ms: float, limit_bound: bool) -> None:
+        """
+        Update the latency averages and grow or shrink the limit. Caller holds the lock.
+
+        Args:
+            latency_ms: Upstream latency of the finished call
+            limit_bound: Whether the limit was holding back work when the call finished
+        """
+        if self._short_latency is None:
+            self._short_latency = self._long_latency = latency_ms
+        else:
+            self._short_latency += SHORT_EWMA_ALPHA * (latency_ms - self._short_latency)
+            self._long_latency += LONG_EWMA_ALPHA * (latency_ms - self._long_latency)
+
+        if self._short_latency > self._long_latency * LATENCY_TOLERANCE:
+            self._decrease(LATENCY_BACKOFF, "latency rising")
+        elif limit_bound:
+            # Additive increase: about one extra slot per limit's worth of successes
+            self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+
+    def _decrease(self, factor: float, reason: str) -> None:
+        """Shrink the limit multiplicatively, at most once per cooldown. Caller holds the lock."""
+        now = time.monotonic()
+        if now - self._last_decrease < DECREASE_COOLDOWN:
+            return
+        self._last_decrease = now
+        old_limit = self._limit
+        self._limit = max(self.min_limit, self._limit * factor)
+        logger.info(f"{self.provider} concurrency limit {old_limit:.1f} -> {self._limit:.1f} ({reason})")
+
+    def _dispatch(self) -> None:
+        """Grant free slots to queued requests by weighted fair queuing. Caller holds the lock."""
+        granted = False
+        while self._in_flight < int(self._limit):
+            candidates = [priority for priority in PRIORITIES if self._queues[priority]]
+            if not candidates:
+                break
+            # Lowest pass goes next; ties go to the higher priority class
+            priority = min(candidates, key=lambda p: self._pass[p])
+            self._global_pass = self._pass[priority]
+            self._pass[priority] += 1 / PRIORITY_WEIGHTS[priority]
+
+            waiter = self._queues[priority].popleft()
+            waiter.granted = True
+            self._in_flight += 1
+            granted = True
+
+        if granted:
+            self._condition.notify_all()
+
+    def _wake_all(self) -> None:
+        """Wake queued waiters so they can notice a cancellation."""
+        with self._condition:
+            self._condition.notify_all()
+
+
+def create_provider_scheduler(provider: str) -> ProviderScheduler:
+    """Helper function to create a scheduler configured from environment variables."""
+    return ProviderScheduler(
+        provider,
+        initial_limit=float(os.getenv("SCHEDULER_INITIAL_LIMIT", "8")),
+        min_limit=float(os.getenv("SCHEDULER_MIN_LIMIT", "1")),
+        max_limit=float(os.getenv("SCHEDULER_MAX_LIMIT", "64")),
+        max_queue=int(os.getenv("SCHEDULER_MAX_QUEUE", "1000")),
+        queue_timeout=float(os.getenv("SCHEDULER_QUEUE_TIMEOUT", "120"))
+    )
@@ -0,0 +1,309 @@
+"""
+WebSocket Chat Session
+
+This module implements the chat protocol spoken over a single persistent
+WebSocket connection. A client can start several generations at once, receive
+their tokens as they are produced, and cancel any of them by ID.
+
+Client -> server messages:
+    {"type": "generate", "id": "1", "provider": "openai", "model": "model-id",
+     "prompt": "User prompt text", "system_prompt": "Optional", "document_id": "Optional",
+     "priority": "interactive" (default) | "default" | "bulk"}
+    {"type": "cancel", "id": "1"}
+    {"type": "ping"}
+
+Server -> client messages:
+    {"type": "token", "id": "1", "text": "..."}
+    {"type": "done", "id": "1", "latency_ms": ..., "input_tokens": ..., ...}
+    {"type": "cancelled", "id": "1"}
+    {"type": "error", "id": "1", "message": "..."}
+    {"type": "pong"}
+
+Author: Pradyun Magal
+Date: March 2025
+"""
+
+import json
+import logging
+import queue
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from src.cancellation.registry import (
+    CancellationToken, RequestRegistry,
+    REASON_CLIENT_DISCONNECT, REASON_EXPLICIT, REASON_SLOW_CLIENT
+)
+from src.documents.store import DocumentContent, DocumentStore
+from src.errors.exceptions import DocumentNotFoundError, RequestCancelledError, SchedulerOverloadedError
+from src.managers.base_manager import BaseManager, GenerationResult, first_token_latency
+from src.models.err_response import ErrorMessages
+from src.scheduling.scheduler import PRIORITIES, PRIORITY_INTERACTIVE, ProviderScheduler
+
+# Configure module logger
+logger = logging.getLogger(__name__)
+
+# Maximum number of generations a single connection may run at once
+MAX_GENERATIONS = 4
+
+# Maximum number of messages waiting to be written to a connection
+SEND_BUFFER_SIZE = 256
+
+# Seconds a generation may stay blocked on a full send buffer before it is cancelled
+SEND_STALL_TIMEOUT = 30.0
+
+# How often blocked threads re-check for cancellation, in seconds
+POLL_INTERVAL = 0.5
+
+
+class ChatSocketSession:
+    """
+    Chat protocol handler for one WebSocket connection.
+
+    This class handles:
+    - Dispatching generate, cancel and ping messages from the client
+    - Running each generation on its own thread via the managers' stream API
+    - Writing outbound messages from a bounded buffer on a single sender thread
+
+    The bounded buffer provides backpressure: when a client reads slowly the
+    buffer fills, generation threads stop pulling from the provider, and a
+    generation that stays blocked for SEND_STALL_TIMEOUT is cancelled. The
+    receive loop never blocks on the buffer, so cancel messages are always read.
+    """
+
+    def __init__(self, ws: Any, managers: Dict[str, BaseManager], registry: RequestRegistry,
+                 client_key: str = "", document_store: Optional[DocumentStore] = None,
+                 schedulers: Optional[Dict[str, ProviderScheduler]] = None):
+        """
+        Initialize the session.
+
+        Args:
+            ws: The WebSocket connection (supports send, receive and close)
+            managers: Map of provider names to their managers
+            registry: Registry that tracks and counts in-flight generations
+            client_key: Identifier of the client, used for usage accounting
+            document_store: Store used to resolve `document_id` in generate messages
+            schedulers: Map of provider names to the schedulers that admit their calls
+        """
+        self.ws = ws
+        self.managers = managers
+        self.registry = registry
+        self.client_key = client_key
+        self.document_store = document_store
+        self.schedulers = schedulers or {}
+
+        self._outbound: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=SEND_BUFFER_SIZE)
+        self._closed = threading.Event()
+        self._lock = threading.Lock()
+        # Generation ID -> (registry request ID, cancellation token)
+        self._active: Dict[str, Tuple[str, CancellationToken]] = {}
+
+    def run(self) -> None:
+        """Serve the connection until the client disconnects."""
+        sender = threading.Thread(target=self._send_loop, name="chat-socket-sender", daemon=True)
+        sender.start()
+
+        try:
+            while not self._closed.is_set():
+                raw = self.ws.receive(timeout=POLL_INTERVAL)
+                if raw is None:
+                    continue
+                self._handle(raw)
+        except Exception as e:
+            # The WebSocket library signals a client disconnect with an exception
+            logger.info(f"Chat socket closed: {str(e)}")
+        finally:
+            self._close()
+            sender.join(POLL_INTERVAL * 2)
+
+    def _close(self) -> None:
+        """Mark the session closed and cancel every in-flight generation."""
+        self._closed.set()
+        with self._lock:
+            tokens = [token for _, token in self._active.values()]
+        for token in tokens:
+            token.cancel(REASON_CLIENT_DISCONNECT)
+
+    def _handle(self, raw: Any) -> None:
+        """Parse and dispatch one client message."""
+        try:
+            message = json.loads(raw)
+        except (TypeError, ValueError):
+            logger.warning("Invalid chat socket message")
+            self._reply({"type": "error", "message": ErrorMessages.BAD_REQUEST})
+            return
+
+        if not isinstance(message, dict):
+            self._reply({"type": "error", "message": ErrorMessages.BAD_REQUEST})
+            return
+
+        message_type = message.get("type")
+        if message_type == "generate":
+            self._start_generation(message)
+        elif message_type == "cancel":
+            self._cancel_generation(str(message.get("id", "")))
+        elif message_type == "ping":
+            self._reply({"type": "pong"})
+        else:
+            logger.warning(f"Unknown chat socket message type: {message_type}")
+            self._reply({"type": "error", "id": message.get("id"), "message": ErrorMessages.BAD_REQUEST})
+
+    def _start_generation(self, message: Dict[str, Any]) -> None:
+        """Validate a generate message and start it on a new thread."""
+        generation_id = str(message.get("id", ""))
+        provider = message.get("provider")
+        model = message.get("model")
+        prompt = message.get("prompt")
+
+        priority = message.get("priority") or PRIORITY_INTERACTIVE
+
+        if (not generation_id or provider not in self.managers or not model or prompt is None
+                or priority not in PRIORITIES):
+            logger.warning("Invalid generate message")
+            self._reply({"type": "error", "id": generation_id or None, "message": ErrorMessages.BAD_REQUEST})
+            return
+
+        document: Optional[DocumentContent] = None
+        if message.get("document_id"):
+            try:
+                if self.document_store is None:
+                    raise DocumentNotFoundError(message["document_id"])
+                document = self.document_store.load(str(message["document_id"]))
+            except DocumentNotFoundError as e:
+                logger.warning(str(e))
+                self._reply({"type": "error", "id": generation_id, "message": ErrorMessages.NOT_FOUND})
+                return
+
+        with self._lock:
+            if generation_id in self._active:
+                error = "Generation ID already in use"
+            elif len(self._active) >= MAX_GENERATIONS:
+                error = f"At most {MAX_GENERATIONS} concurrent generations are allowed"
+            else:
+                error = None
+                request_id, cancel_token = self.registry.register()
+                self._active[generation_id] = (request_id, cancel_token)
+
+        if error:
+            logger.warning(f"Rejected generation '{generation_id}': {error}")
+            self._reply({"type": "error", "id": generation_id, "message": error})
+            return
+
+        thread = threading.Thread(
+            target=self._run_generation,
+            args=(generation_id, request_id, self.managers[provider], self.schedulers.get(provider),
+                  priority, model, prompt, message.get("system_prompt", ""), cancel_token, document),
+            name=f"chat-socket-{generation_id}",
+            daemon=True
+        )
+        thread.start()
+
+    def _cancel_generation(self, generation_id: str) -> None:
+        """Signal a running generation to stop."""
+        with self._lock:
+            entry = self._active.get(generation_id)
+        if entry is None:
+            self._reply({"type": "error", "id": generation_id, "message": ErrorMessages.NOT_FOUND})
+            return
+        logger.info(f"Cancelling generation '{generation_id}'")
+        entry[1].cancel(REASON_EXPLICIT)
+
+    def _run_generation(self, generation_id: str, request_id: str, manager: BaseManager,
+                        scheduler: Optional[ProviderScheduler], priority: str, model: str,
+                        prompt: str, system_prompt: str, cancel_token: CancellationToken,
+                        document: Optional[DocumentContent] = None) -> None:
+        """Stream one generation to the client, stopping early if cancelled."""
+        def stream_to_client() -> GenerationResult:
+            stream = manager.stream(prompt, system_prompt, self.client_key, model, cancel_token, document)
+            try:
+                for text in stream:
+                    if not self._send({"type": "token", "id": generation_id, "text": text}, cancel_token):
+                        # The client is not keeping up; give up on this generation
+                        cancel_token.cancel(REASON_SLOW_CLIENT)
+                        break
+            finally:
+                stream.close()
+            return stream.result
+
+        try:
+            if scheduler is not None:
+                # Time to first token is measured before any send, so a slow
+                # reader cannot make the provider look congested
+                result = scheduler.run(stream_to_client, priority, cancel_token, first_token_latency)
+            else:
+                result = stream_to_client()
+
+            if cancel_token.cancelled:
+                self._send({"type": "cancelled", "id": generation_id})
+            else:
+                self._send({
+                    "type": "done",
+                    "id": generation_id,
+                    "provider": result.provider,
+                    "model": result.model,
+                    "latency_ms": result.latency_ms,
+                    "input_tokens": result.input_tokens,
+                    "output_tokens": result.output_tokens,
+                    "cached_tokens": result.cached_tokens
+                })
+        except RequestCancelledError:
+            self._send({"type": "cancelled", "id": generation_id})
+        except SchedulerOverloadedError as e:
+            logger.warning(f"Generation '{generation_id}' not admitted: {str(e)}")
+            self._send({"type": "error", "id": generation_id, "message": ErrorMessages.SERVICE_UNAVAILABLE})
+        except Exception as e:
+            logger.error(f"Error in generation '{generation_id}': {str(e)}")
+            self._send({"type": "error", "id": generation_id, "message": ErrorMessages.INTERNAL_SERVER_ERROR})
+        finally:
+            with self._lock:
+                self._active.pop(generation_id, None)
+            self.registry.unregister(request_id)
+
+    def _reply(self, message: Dict[str, Any]) -> None:
+        """
+        Queue a reply to a client message without blocking the receive loop.
+
+        If the send buffer is full the client is not reading, so the reply is
+        dropped. Waiting for space would stop the loop from reading the
+        client's cancel messages exactly when backpressure makes them matter.
+        """
+        try:
+            self._outbound.put_nowait(message)
+        except queue.Full:
+            logger.warning(f"Chat socket send buffer full, dropping {message.get('type')} reply")
+
+    def _send(self, message: Dict[str, Any], cancel_token: Optional[CancellationToken] = None) -> bool:
+        """
+        Queue a message for the sender thread, blocking while the buffer is full.
+
+        Args:
+            message: The message to send
+            cancel_token: Stop waiting early if this token is cancelled
+
+        Returns:
+            True if the message was queued, False if the session closed, the
+            generation was cancelled, or the buffer stayed full too long
+        """
+        waited = 0.0
+        while not self._closed.is_set():
+            try:
+                self._outbound.put(message, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                waited += POLL_INTERVAL
+                if (cancel_token is not None and cancel_token.cancelled) or waited >= SEND_STALL_TIMEOUT:
+                    logger.warning("Chat socket send buffer stalled, dropping message")
+                    return False
+        return False
+
+    def _send_loop(self) -> None:
+        """Write queued messages to the WebSocket until the session closes."""
+        while not self._closed.is_set():
+            try:
+                message = self._outbound.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            try:
+                self.ws.send(json.dumps(message))
+            except Exception as e:
+                logger.info(f"Chat socket send failed: {str(e)}")
+                self._close()
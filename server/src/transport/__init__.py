@@ -0,0 +1,3 @@
+"""
+Transport package
+"""
@@ -0,0 +1,231 @@
+"""
+Shared HTTP Transport
+
+This module builds the single HTTP client shared by the OpenAI and Anthropic
+SDK clients. It has explicit connection pool limits, a long keep-alive expiry
+and optional HTTP/2, so upstream requests reuse warm TLS connections instead
+of opening new ones. It can also pre-warm connections at startup.
+
+Every 429 response is reported to throttle listeners registered for the
+provider's base URL, including 429s the SDKs retry on their own, so the
+schedulers see rate limiting as soon as it starts.
+
+The client is built with the HTTP library the installed SDKs are built on
+(httpx, or httpx2 in newer SDK releases), since the SDKs reject a client from
+the other one.
+
+All settings come from environment variables (see TransportConfig.from_env).
+
+Author: Pradyun Magal
+Date: March 2025
+"""
+
+import importlib
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Union
+
+import anthropic
+import openai
+
+# Configure module logger
+logger = logging.getLogger(__name__)
+
+
+def _sdk_http_library(sdk_client_class: type):
+    """Return the HTTP library module whose Client the given SDK client class extends."""
+    return importlib.import_module(sdk_client_class.__bases__[0].__module__.split(".")[0])
+
+
+# httpx or httpx2, whichever the SDKs accept as `http_client`
+httpx = _sdk_http_library(openai.DefaultHttpxClient)
+if _sdk_http_library(anthropic.DefaultHttpxClient) is not httpx:
+    raise ImportError(
+        "The installed openai and anthropic SDKs are built on different HTTP libraries "
+        "and cannot share one client; install the versions pinned in pyproject.toml"
+    )
+
+# Overall request timeout in seconds; generations can legitimately take minutes
+REQUEST_TIMEOUT = 600.0
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    """Read a boolean environment variable ("1", "true", "yes" are true)."""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+@dataclass
+class TransportConfig:
+    """Connection settings for the shared upstream HTTP client."""
+    http2: bool = True
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 60.0
+    connect_timeout: float = 5.0
+    prewarm_connections: int = 2
+    verify: Union[bool, str] = True
+    openai_base_url: Optional[str] = None
+    anthropic_base_url: Optional[str] = None
+
+    @classmethod
+    def from_env(cls) -> "TransportConfig":
+        """
+        Build a config from environment variables.
+
+        Variables:
+            HTTP_HTTP2: Enable HTTP/2 when the h2 package is installed (default true)
+            HTTP_MAX_CONNECTIONS: Maximum open connections (default 100)
+            HTTP_MAX_KEEPALIVE: Maximum idle connections kept open (default 20)
+            HTTP_KEEPALIVE_EXPIRY: Seconds an idle connection is kept (default 60)
+            HTTP_CONNECT_TIMEOUT: Connect timeout in seconds (default 5)
+            HTTP_PREWARM_CONNECTIONS: Connections opened per host at startup (default 2, 0 disables)
+            HTTP_CA_BUNDLE: CA bundle to verify upstream certificates against
+            OPENAI_BASE_URL / ANTHROPIC_BASE_URL: Point a provider at a stand-in server
+        """
+        return cls(
+            http2=_env_bool("HTTP_HTTP2", True),
+            max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE", "20")),
+            keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60")),
+            connect_timeout=float(os.getenv("HTTP_CONNECT_TIMEOUT", "5")),
+            prewarm_connections=int(os.getenv("HTTP_PREWARM_CONNECTIONS", "2")),
+            verify=os.getenv("HTTP_CA_BUNDLE") or True,
+            openai_base_url=os.getenv("OPENAI_BASE_URL") or None,
+            anthropic_base_url=os.getenv("ANTHROPIC_BASE_URL") or None
+        )
+
+
+def http2_available() -> bool:
+    """Whether the optional h2 package needed for HTTP/2 is installed."""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+_throttle_listeners: Dict[str, Callable[[], None]] = {}
+_throttle_listeners_lock = threading.Lock()
+
+
+def add_throttle_listener(base_url: str, callback: Callable[[], None]) -> None:
+    """
+    Call `callback` whenever a request under `base_url` gets a 429 response.
+
+    When several base URLs match a request, the longest one wins.
+
+    Args:
+        base_url: URL prefix of the provider's API
+        callback: Function to call on each 429
+    """
+    with _throttle_listeners_lock:
+        _throttle_listeners[str(base_url).rstrip("/")] = callback
+
+
+def _notify_throttled(response: httpx.Response) -> None:
+    """Response hook that reports 429s to the matching throttle listener."""
+    if response.status_code != 429:
+        return
+    url = str(response.request.url)
+    with _throttle_listeners_lock:
+        matches = [base_url for base_url in _throttle_listeners if url.startswith(base_url)]
+        callback = _throttle_listeners[max(matches, key=len)] if matches else None
+    if callback is not None:
+        callback()
+
+
+def build_http_client(config: TransportConfig) -> httpx.Client:
+    """
+    Build an HTTP client from a transport config.
+
+    Args:
+        config: The connection settings
+
+    Returns:
+        A client suitable for passing to the SDKs as `http_client`
+    """
+    http2 = config.http2
+    if http2 and not http2_available():
+        logger.warning("HTTP/2 requested but the 'h2' package is not installed; using HTTP/1.1")
+        http2 = False
+
+    limits = httpx.Limits(
+        max_connections=config.max_connections,
+        max_keepalive_connections=config.max_keepalive_connections,
+        keepalive_expiry=config.keepalive_expiry
+    )
+    logger.info(
+        f"Building shared HTTP client (http2={http2}, max_connections={config.max_connections}, "
+        f"keepalive_expiry={config.keepalive_expiry}s)"
+    )
+    return httpx.Client(
+        http2=http2,
+        limits=limits,
+        timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=config.connect_timeout),
+        verify=config.verify,
+        follow_redirects=True,
+        event_hooks={"response": [_notify_throttled]}
+    )
+
+
+def prewarm_connections(client: httpx.Client, base_urls: List[str], connections_per_host: int,
+                        timeout: float = 10.0) -> None:
+    """
+    Open connections to each host ahead of the first real request.
+
+    Each host gets `connections_per_host` concurrent HEAD requests, so the
+    TCP and TLS handshakes happen now and the connections go back into the
+    pool. Response status codes are irrelevant and failures are only logged.
+
+    Args:
+        client: The shared HTTP client
+        base_urls: Provider base URLs to connect to
+        connections_per_host: Number of connections to open per host
+        timeout: Maximum seconds to wait for the handshakes
+    """
+    if connections_per_host <= 0:
+        return
+
+    def warm(url: str) -> None:
+        try:
+            client.head(url, timeout=timeout)
+        except httpx.HTTPError as e:
+            logger.warning(f"Could not pre-warm connection to {url}: {str(e)}")
+
+    threads = [
+        threading.Thread(target=warm, args=(url,), name="http-prewarm", daemon=True)
+        for url in base_urls
+        for _ in range(connections_per_host)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout)
+    logger.info(f"Pre-warmed {connections_per_host} connection(s) to {len(base_urls)} host(s)")
+
+
+_transport_config: Optional[TransportConfig] = None
+_shared_client: Optional[httpx.Client] = None
+_shared_client_lock = threading.Lock()
+
+
+def get_transport_config() -> TransportConfig:
+    """Return the process-wide transport config, read from the environment once."""
+    global _transport_config
+    if _transport_config is None:
+        _transport_config = TransportConfig.from_env()
+    return _transport_config
+
+
+def get_shared_http_client() -> httpx.Client:
+    """Return the process-wide HTTP client, creating it on first use."""
+    global _shared_client
+    with _shared_client_lock:
+        if _shared_client is None:
+            _shared_client = build_http_client(get_transport_config())
+        return _shared_client
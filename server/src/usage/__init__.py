@@ -0,0 +1,3 @@
+"""
+Usage package
+"""
@@ -0,0 +1,501 @@
+"""
+Usage Ledger
+
+This module records token usage, latency and estimated cost for every
+provider request. Records are buffered in memory and written to SQLite in
+batches by a background thread, so accounting never blocks the request path.
+It also provides the aggregate queries used by the usage endpoints.
+
+Alongside the raw records, the writer keeps hourly per-key, per-model rollups
+up to date in the same transaction. Aggregates read whole hours from the
+rollups and only the partial hours at either end of the range from the raw
+records, so their cost does not grow with the number of requests.
+
+Author: Pradyun Magal
+Date: March 2025
+"""
+
+import atexit
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from src.usage.pricing import estimate_cost
+
+# Configure module logger
+logger = logging.getLogger(__name__)
+
+# Default location of the ledger database (overridable via USAGE_DB_PATH)
+DEFAULT_DB_PATH = "usage.db"
+
+# Width of a rollup bucket in seconds
+ROLLUP_BUCKET_SECONDS = 3600
+
+# Time series with buckets that are not whole rollup buckets scan the raw
+# records, so they need an explicit range of at most this many seconds and buckets
+MAX_RAW_RANGE_SECONDS = 24 * 3600
+MAX_RAW_BUCKETS = 1440
+
+# How a request ended; cancelled and failed requests can still have been billed
+STATUS_COMPLETED = "completed"
+STATUS_CANCELLED = "cancelled"
+STATUS_FAILED = "failed"
+
+CREATE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS usage_records (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created_at REAL NOT NULL,
+        client_key TEXT NOT NULL,
+        provider TEXT NOT NULL,
+        model TEXT NOT NULL,
+        input_tokens INTEGER NOT NULL,
+        output_tokens INTEGER NOT NULL,
+        cached_tokens INTEGER NOT NULL,
+        cache_write_tokens INTEGER NOT NULL,
+        latency_ms REAL NOT NULL,
+        cost_usd REAL NOT NULL,
+        status TEXT NOT NULL DEFAULT 'completed'
+    )
+"""
+
+CREATE_ROLLUP_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS usage_rollups (
+        bucket_start INTEGER NOT NULL,
+        client_key TEXT NOT NULL,
+        provider TEXT NOT NULL,
+        model TEXT NOT NULL,
+        requests INTEGER NOT NULL,
+        cancelled_requests INTEGER NOT NULL,
+        failed_requests INTEGER NOT NULL,
+        input_tokens INTEGER NOT NULL,
+        output_tokens INTEGER NOT NULL,
+        cached_tokens INTEGER NOT NULL,
+        cache_write_tokens INTEGER NOT NULL,
+        latency_ms_total REAL NOT NULL,
+        cost_usd REAL NOT NULL,
+        PRIMARY KEY (bucket_start, client_key, provider, model)
+    ) WITHOUT ROWID
+"""
+
+INDEXES = [
+    # Raw records are only read for the partial buckets at the ends of a time
+    # range; this index covers those reads so they never touch the table
+    """
+    CREATE INDEX IF NOT EXISTS idx_usage_records_covering ON usage_records (
+        created_at, client_key, provider, model, input_tokens, output_tokens,
+        cached_tokens, cache_write_tokens, latency_ms, cost_usd, status
+    )
+    """,
+]
+
+# Indexes from earlier versions, replaced by ones that also cover status
+DROPPED_INDEXES = ["idx_usage_created_at_covering"]
+
+# Columns added after the tables were first created, applied to older databases
+ADDED_COLUMNS = {
+    "usage_records": {
+        "status": "TEXT NOT NULL DEFAULT 'completed'",
+    },
+    "usage_rollups": {
+        "cancelled_requests": "INTEGER NOT NULL DEFAULT 0",
+        "failed_requests": "INTEGER NOT NULL DEFAULT 0",
+    },
+}
+
+INSERT_SQL = """
+    INSERT INTO usage_records (
+        created_at, client_key, provider, model, input_tokens, output_tokens,
+        cached_tokens, cache_write_tokens, latency_ms, cost_usd, status
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+ROLLUP_UPSERT_SQL = """
+    INSERT INTO usage_rollups (
+        bucket_start, client_key, provider, model, requests, cancelled_requests,
+        failed_requests, input_tokens, output_tokens, cached_tokens,
+        cache_write_tokens, latency_ms_total, cost_usd
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (bucket_start, client_key, provider, model) DO UPDATE SET
+        requests = requests + excluded.requests,
+        cancelled_requests = cancelled_requests + excluded.cancelled_requests,
+        failed_requests = failed_requests + excluded.failed_requests,
+        input_tokens = input_tokens + excluded.input_tokens,
+        output_tokens = output_tokens + excluded.output_tokens,
+        cached_tokens = cached_tokens + excluded.cached_tokens,
+        cache_write_tokens = cache_write_tokens + excluded.cache_write_tokens,
+        latency_ms_total = latency_ms_total + excluded.latency_ms_total,
+        cost_usd = cost_usd + excluded.cost_usd
+"""
+
+# Per-group sums over raw records, in the same shape as a rollup row
+RAW_SUM_COLUMNS = """
+    COUNT(*) AS requests,
+    SUM(status = 'cancelled') AS cancelled_requests,
+    SUM(status = 'failed') AS failed_requests,
+    SUM(input_tokens) AS input_tokens,
+    SUM(output_tokens) AS output_tokens,
+    SUM(cached_tokens) AS cached_tokens,
+    SUM(cache_write_tokens) AS cache_write_tokens,
+    SUM(latency_ms) AS latency_ms_total,
+    SUM(cost_usd) AS cost_usd
+"""
+
+# Per-group sums over rollup rows
+ROLLUP_SUM_COLUMNS = """
+    SUM(requests) AS requests,
+    SUM(cancelled_requests) AS cancelled_requests,
+    SUM(failed_requests) AS failed_requests,
+    SUM(input_tokens) AS input_tokens,
+    SUM(output_tokens) AS output_tokens,
+    SUM(cached_tokens) AS cached_tokens,
+    SUM(cache_write_tokens) AS cache_write_tokens,
+    SUM(latency_ms_total) AS latency_ms_total,
+    SUM(cost_usd) AS cost_usd
+"""
+
+# Final aggregates, combining raw and rollup sums
+AGGREGATE_COLUMNS = """
+    SUM(requests) AS requests,
+    SUM(cancelled_requests) AS cancelled_requests,
+    SUM(failed_requests) AS failed_requests,
+    SUM(input_tokens) AS input_tokens,
+    SUM(output_tokens) AS output_tokens,
+    SUM(cached_tokens) AS cached_tokens,
+    SUM(cache_write_tokens) AS cache_write_tokens,
+    SUM(latency_ms_total) / SUM(requests) AS avg_latency_ms,
+    SUM(cost_usd) AS cost_usd
+"""
+
+
+@dataclass
+class UsageRecord:
+    """A single provider request as stored in the ledger."""
+    client_key: str
+    provider: str
+    model: str
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_tokens: int = 0
+    cache_write_tokens: int = 0
+    latency_ms: float = 0.0
+    cost_usd: float = 0.0
+    status: str = STATUS_COMPLETED
+    created_at: float = field(default_factory=time.time)
+
+    def to_row(self) -> tuple:
+        """Return the record as a tuple matching INSERT_SQL."""
+        return (
+            self.created_at, self.client_key, self.provider, self.model,
+            self.input_tokens, self.output_tokens, self.cached_tokens,
+            self.cache_write_tokens, self.latency_ms, self.cost_usd, self.status
+        )
+
+
+class UsageLedger:
+    """
+    Buffered, write-behind ledger of provider usage.
+
+    This class handles:
+    - Accepting usage records without blocking the caller
+    - Flushing buffered records to SQLite in batches on a background thread
+    - Aggregating usage per client key, per model and per time bucket
+    """
+
+    def __init__(self, db_path: str = DEFAULT_DB_PATH, batch_size: int = 500,
+                 flush_interval: float = 1.0, max_buffer: int = 100_000):
+        """
+        Initialize the ledger and start the writer thread.
+
+        Args:
+            db_path: Path to the SQLite database file
+            batch_size: Maximum number of records written per transaction
+            flush_interval: Maximum seconds a record waits in the buffer
+            max_buffer: Maximum number of buffered records before new ones are dropped
+        """
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+
+        self._queue: "queue.Queue[Any]" = queue.Queue(maxsize=max_buffer)
+        self._stopped = threading.Event()
+
+        self._init_db()
+
+        self._writer = threading.Thread(target=self._run, name="usage-ledger-writer", daemon=True)
+        self._writer.start()
+
+        logger.info(f"UsageLedger initialized with database '{db_path}'")
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a new connection to the ledger database."""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _init_db(self) -> None:
+        """Create the tables and indexes, upgrading a ledger from an earlier version."""
+        conn = self._connect()
+        try:
+            # WAL lets the query endpoints read while the writer thread commits
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                conn.execute(CREATE_TABLE_SQL)
+                conn.execute(CREATE_ROLLUP_TABLE_SQL)
+                for table, columns in ADDED_COLUMNS.items():
+                    existing = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+                    for column, definition in columns.items():
+                        if column not in existing:
+                            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+                for index in DROPPED_INDEXES:
+                    conn.execute(f"DROP INDEX IF EXISTS {index}")
+                for statement in INDEXES:
+                    conn.execute(statement)
+        finally:
+            conn.close()
+
+    def record(self, record: UsageRecord) -> None:
+        """
+        Buffer a usage record for writing.
+
+        This never blocks: if the buffer is full the record is dropped and
+        counted in `dropped`.
+
+        Args:
+            record: The usage record to store
+        """
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("Usage buffer full, dropping record")
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until every record buffered before this call has been written.
+
+        Args:
+            timeout: Maximum seconds to wait (None waits indefinitely)
+
+        Returns:
+            True if the buffer was flushed, False on timeout
+        """
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def close(self, timeout: Optional[float] = 5.0) -> None:
+        """
+        Flush remaining records and stop the writer thread.
+
+        Args:
+            timeout: Maximum seconds to wait for the final flush
+        """
+        if self._stopped.is_set():
+            return
+        self.flush(timeout)
+        self._stopped.set()
+        self._writer.join(timeout)
+
+    def _run(self) -> None:
+        """Writer thread loop: collect records into batches and commit them."""
+        conn = self._connect()
+        try:
+            while not self._stopped.is_set():
+                batch: List[UsageRecord] = []
+                waiters: List[threading.Event] = []
+                deadline = time.monotonic() + self.flush_interval
+
+                # Gather until the batch is full, the interval expires or a flush is requested
+                while len(batch) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if isinstance(item, threading.Event):
+                        waiters.append(item)
+                        break
+                    batch.append(item)
+
+                if batch:
+                    self._write_batch(conn, batch)
+                for waiter in waiters:
+                    waiter.set()
+        finally:
+            conn.close()
+
+    def _write_batch(self, conn: sqlite3.Connection, batch: List[UsageRecord]) -> None:
+        """Write a batch of records and update their rollups in a single transaction."""
+        rollups: Dict[tuple, List[float]] = {}
+        for record in batch:
+            bucket_start = int(record.created_at // ROLLUP_BUCKET_SECONDS) * ROLLUP_BUCKET_SECONDS
+            sums = rollups.setdefault(
+                (bucket_start, record.client_key, record.provider, record.model), [0] * 9
+            )
+            for i, value in enumerate((
+                1, record.status == STATUS_CANCELLED, record.status == STATUS_FAILED,
+                record.input_tokens, record.output_tokens, record.cached_tokens,
+                record.cache_write_tokens, record.latency_ms, record.cost_usd
+            )):
+                sums[i] += value
+
+        try:
+            with conn:
+                conn.executemany(INSERT_SQL, [record.to_row() for record in batch])
+                conn.executemany(ROLLUP_UPSERT_SQL, [key + tuple(sums) for key, sums in rollups.items()])
+        except sqlite3.Error as e:
+            logger.error(f"Error writing {len(batch)} usage records: {str(e)}")
+
+    def _query(self, sql: str, params: tuple) -> List[Dict[str, Any]]:
+        """Run a read-only query and return the rows as dictionaries."""
+        conn = self._connect()
+        try:
+            return [dict(row) for row in conn.execute(sql, params).fetchall()]
+        finally:
+            conn.close()
+
+    def _aggregate(self, group_columns: List[str], since: Optional[float], until: Optional[float],
+                   order_by: str, bucket_seconds: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Aggregate usage over [since, until), grouped by the given columns.
+
+        Whole rollup buckets inside the range are read from the rollups; the
+        partial buckets at either end are summed from the raw records.
+
+        Args:
+            group_columns: Columns to group by
+            since: Start of the time range as a unix timestamp (inclusive)
+            until: End of the time range as a unix timestamp (exclusive)
+            order_by: ORDER BY clause for the result
+            bucket_seconds: Also group by time buckets of this width, reported as `bucket_start`
+        """
+        since = since if since is not None else 0.0
+        until = until if until is not None else time.time() + 1
+
+        # [first_bucket, last_bucket) is the span of whole rollup buckets in the range
+        first_bucket = -(-since // ROLLUP_BUCKET_SECONDS) * ROLLUP_BUCKET_SECONDS
+        last_bucket = until // ROLLUP_BUCKET_SECONDS * ROLLUP_BUCKET_SECONDS
+        # Output buckets that do not line up with rollup buckets need the raw records
+        misaligned = bucket_seconds is not None and bucket_seconds % ROLLUP_BUCKET_SECONDS != 0
+        if first_bucket >= last_bucket or misaligned:
+            first_bucket = last_bucket = until
+
+        raw_columns = list(group_columns)
+        rollup_columns = list(group_columns)
+        if bucket_seconds is not None:
+            raw_columns.insert(0, f"CAST(created_at / {bucket_seconds} AS INTEGER) * {bucket_seconds} AS bucket_start")
+            rollup_columns.insert(0, f"bucket_start / {bucket_seconds} * {bucket_seconds}")
+            group_columns = ["bucket_start"] + group_columns
+        positions = ", ".join(str(i) for i in range(1, len(group_columns) + 1))
+
+        return self._query(
+            f"SELECT {', '.join(group_columns)}, {AGGREGATE_COLUMNS} FROM ("
+            f" SELECT {', '.join(raw_columns)}, {RAW_SUM_COLUMNS} FROM usage_records"
+            f" WHERE (created_at >= ? AND created_at < ?) OR (created_at >= ? AND created_at < ?)"
+            f" GROUP BY {positions}"
+            f" UNION ALL"
+            f" SELECT {', '.join(rollup_columns)}, {ROLLUP_SUM_COLUMNS} FROM usage_rollups"
+            f" WHERE bucket_start >= ? AND bucket_start < ?"
+            f" GROUP BY {positions}"
+            f") GROUP BY {positions} ORDER BY {order_by}",
+            (since, first_bucket, last_bucket, until, first_bucket, last_bucket)
+        )
+
+    def usage_by_key(self, since: Optional[float] = None,
+                     until: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Aggregate usage per client key.
+
+        Args:
+            since: Start of the time range as a unix timestamp (inclusive)
+            until: End of the time range as a unix timestamp (exclusive)
+
+        Returns:
+            A list of aggregates, one per client key
+        """
+        return self._aggregate(["client_key"], since, until, "cost_usd DESC")
+
+    def usage_by_model(self, since: Optional[float] = None,
+                       until: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Aggregate usage per provider and model.
+
+        Args:
+            since: Start of the time range as a unix timestamp (inclusive)
+            until: End of the time range as a unix timestamp (exclusive)
+
+        Returns:
+            A list of aggregates, one per (provider, model)
+        """
+        return self._aggregate(["provider", "model"], since, until, "cost_usd DESC")
+
+    def usage_by_time(self, bucket_seconds: int = 3600, since: Optional[float] = None,
+                      until: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Aggregate usage per time bucket.
+
+        Args:
+            bucket_seconds: Width of each bucket in seconds
+            since: Start of the time range as a unix timestamp (inclusive)
+            until: End of the time range as a unix timestamp (exclusive)
+
+        Returns:
+            A list of aggregates ordered by bucket start time
+
+        Raises:
+            ValueError: If the bucket width is not positive, or it is not a whole
+                number of hours and the range is missing or too large
+        """
+        if bucket_seconds <= 0:
+            raise ValueError("bucket_seconds must be positive")
+        if bucket_seconds % ROLLUP_BUCKET_SECONDS != 0:
+            if since is None or until is None:
+                raise ValueError("Buckets that are not whole hours require both since and until")
+            if until - since > MAX_RAW_RANGE_SECONDS or (until - since) / bucket_seconds > MAX_RAW_BUCKETS:
+                raise ValueError(
+                    f"Buckets that are not whole hours are limited to a {MAX_RAW_RANGE_SECONDS} second "
+                    f"range and {MAX_RAW_BUCKETS} buckets"
+                )
+
+        return self._aggregate([], since, until, "bucket_start", bucket_seconds=int(bucket_seconds))
+
+
+def create_usage_record(client_key: str, provider: str, model: str, input_tokens: int,
+                        output_tokens: int, cached_tokens: int, latency_ms: float,
+                        cache_write_tokens: int = 0, status: str = STATUS_COMPLETED) -> UsageRecord:
+    """Helper function to create a usage record with an estimated cost."""
+    return UsageRecord(
+        client_key=client_key or "anonymous",
+        provider=provider,
+        model=model,
+        input_tokens=input_tokens,
+        output_tokens=output_tokens,
+        cached_tokens=cached_tokens,
+        cache_write_tokens=cache_write_tokens,
+        latency_ms=latency_ms,
+        status=status,
+        cost_usd=estimate_cost(model, input_tokens, output_tokens, cached_tokens, cache_write_tokens)
+    )
+
+
+def create_usage_ledger() -> UsageLedger:
+    """Helper function to create a ledger configured from environment variables."""
+    ledger = UsageLedger(
+        db_path=os.getenv("USAGE_DB_PATH", DEFAULT_DB_PATH),
+        batch_size=int(os.getenv("USAGE_BATCH_SIZE", "500")),
+        flush_interval=float(os.getenv("USAGE_FLUSH_INTERVAL", "1.0"))
+    )
+    atexit.register(ledger.close)
+    return ledger
@@ -0,0 +1,96 @@
+"""
+Model Pricing
+
+This module holds a small price table used to estimate the cost of a request
+from its token counts. Prices are in USD per million tokens and are matched by
+model id prefix, so dated snapshots (e.g. "claude-3-5-sonnet-20241022") pick
+up the price of their family.
+
+Anthropic bills prompt cache writes at a premium over the base input rate
+(1.25x for the default 5 minute cache); OpenAI caches automatically and
+charges cache writes as ordinary input.
+
+Author: Pradyun Magal
+Date: March 2025
+"""
+
+from typing import Dict, Optional, Tuple
+
+# (input, output, cache read, cache write) in USD per million tokens, keyed by model id prefix
+MODEL_PRICES: Dict[str, Tuple[float, float, float, float]] = {
+    # OpenAI
+    "gpt-4o-mini": (0.15, 0.60, 0.075, 0.15),
+    "gpt-4o": (2.50, 10.00, 1.25, 2.50),
+    "gpt-4.1-nano": (0.10, 0.40, 0.025, 0.10),
+    "gpt-4.1-mini": (0.40, 1.60, 0.10, 0.40),
+    "gpt-4.1": (2.00, 8.00, 0.50, 2.00),
+    "gpt-4-turbo": (10.00, 30.00, 10.00, 10.00),
+    "gpt-4": (30.00, 60.00, 30.00, 30.00),
+    "gpt-3.5-turbo": (0.50, 1.50, 0.50, 0.50),
+    "o1-mini": (1.10, 4.40, 0.55, 1.10),
+    "o1": (15.00, 60.00, 7.50, 15.00),
+    "o3-mini": (1.10, 4.40, 0.55, 1.10),
+    "o4-mini": (1.10, 4.40, 0.275, 1.10),
+    # Anthropic
+    "claude-3-opus": (15.00, 75.00, 1.50, 18.75),
+    "claude-opus-4": (15.00, 75.00, 1.50, 18.75),
+    "claude-3-7-sonnet": (3.00, 15.00, 0.30, 3.75),
+    "claude-3-5-sonnet": (3.00, 15.00, 0.30, 3.75),
+    "claude-3-sonnet": (3.00, 15.00, 0.30, 3.75),
+    "claude-sonnet-4": (3.00, 15.00, 0.30, 3.75),
+    "claude-3-5-haiku": (0.80, 4.00, 0.08, 1.00),
+    "claude-3-haiku": (0.25, 1.25, 0.03, 0.30),
+}
+
+
+def get_model_price(model: str) -> Optional[Tuple[float, float, float, float]]:
+    """
+    Look up the price entry for a model.
+    
+    Args:
+        model: The model identifier
+        
+    Returns:
+        A tuple of (input, output, cache read, cache write) prices per million
+        tokens, or None if the model is not in the table
+    """
+    if not model:
+        return None
+    
+    # Prefer the longest matching prefix so "gpt-4o-mini" beats "gpt-4o"
+    best_match = None
+    for prefix in MODEL_PRICES:
+        if model.startswith(prefix) and (best_match is None or len(prefix) > len(best_match)):
+            best_match = prefix
+    
+    return MODEL_PRICES[best_match] if best_match else None
+
+
+def estimate_cost(model: str, input_tokens: int, output_tokens: int, cached_tokens: int = 0,
+                  cache_write_tokens: int = 0) -> float:
+    """
+    Estimate the cost of a request in USD.
+    
+    Args:
+        model: The model identifier
+        input_tokens: Total input tokens, including cache reads and writes
+        output_tokens: Output tokens
+        cached_tokens: Input tokens served from the provider's prompt cache
+        cache_write_tokens: Input tokens written to the provider's prompt cache
+        
+    Returns:
+        The estimated cost in USD, or 0.0 for models without a known price
+    """
+    price = get_model_price(model)
+    if price is None:
+        return 0.0
+    
+    input_price, output_price, cached_price, cache_write_price = price
+    uncached_tokens = max(input_tokens - cached_tokens - cache_write_tokens, 0)
+    cost = (
+        uncached_tokens * input_price
+        + cached_tokens * cached_price
+        + cache_write_tokens * cache_write_price
+        + output_tokens * output_price
+    )
+    return cost / 1_000_000
@@ -0,0 +1,333 @@
+"""
+Cancellation Tests
+
+Runs the app on a local Werkzeug server in front of a slow fake provider that
+streams Responses API and Messages API server-sent events. The fake records
+whether each upstream stream ran to completion or was closed by the client,
+which is how the tests see that a cancellation reached the provider.
+
+Author: Pradyun Magal
+Date: March 2025
+"""
+
+import http.client
+import importlib
+import json
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Dict
+
+import pytest
+import simple_websocket
+from werkzeug.serving import make_server
+
+# The fake streams DELTA_COUNT deltas, one every DELTA_INTERVAL seconds, so an
+# uncancelled generation takes several seconds
+DELTA_COUNT = 50
+DELTA_INTERVAL = 0.1
+
+# Upper bound on how long a cancellation may take to reach the provider
+CANCEL_TIMEOUT = 2.0
+
+
+class UpstreamCall:
+    """What the fake provider saw of one streamed request."""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.ended = threading.Event()
+        self.outcome = None
+
+
+class FakeProviderServer(ThreadingHTTPServer):
+    """Slow SSE stand-in for the OpenAI Responses and Anthropic Messages APIs."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeProviderHandler)
+        self._lock = threading.Lock()
+        self._calls: Dict[str, UpstreamCall] = {}
+
+    def expect(self, marker: str) -> UpstreamCall:
+        """Track the upstream request whose body contains `marker`."""
+        call = UpstreamCall()
+        with self._lock:
+            self._calls[marker] = call
+        return call
+
+    def find(self, body: str) -> UpstreamCall:
+        with self._lock:
+            for marker, call in self._calls.items():
+                if marker in body:
+                    return call
+        return UpstreamCall()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class FakeProviderHandler(BaseHTTPRequestHandler):
+    """Streams a fixed number of text deltas in the provider's SSE format."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        model = json.loads(body)["model"]
+        call = self.server.find(body)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        events = openai_events(model) if self.path.endswith("/responses") else anthropic_events(model)
+        call.started.set()
+        try:
+            for index, event in enumerate(events):
+                if 0 < index < DELTA_COUNT:
+                    time.sleep(DELTA_INTERVAL)
+                self.wfile.write(f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode())
+                self.wfile.flush()
+            call.outcome = "completed"
+        except (BrokenPipeError, ConnectionResetError):
+            call.outcome = "closed_by_client"
+        finally:
+            call.ended.set()
+
+
+def openai_events(model: str):
+    for index in range(DELTA_COUNT):
+        yield {"type": "response.output_text.delta", "delta": f"t{index} ", "sequence_number": index,
+               "item_id": "msg", "output_index": 0, "content_index": 0, "logprobs": []}
+    yield {"type": "response.completed", "sequence_number": DELTA_COUNT, "response": {
+        "id": "resp", "object": "response", "created_at": 0, "model": model, "output": [],
+        "parallel_tool_calls": False, "tool_choice": "auto", "tools": [],
+        "usage": {"input_tokens": 5, "output_tokens": DELTA_COUNT, "total_tokens": DELTA_COUNT + 5,
+                  "input_tokens_details": {"cached_tokens": 0},
+                  "output_tokens_details": {"reasoning_tokens": 0}}
+    }}
+
+
+def anthropic_events(model: str):
+    yield {"type": "message_start", "message": {
+        "id": "msg", "type": "message", "role": "assistant", "model": model, "content": [],
+        "stop_reason": None, "stop_sequence": None,
+        "usage": {"input_tokens": 5, "output_tokens": 1}
+    }}
+    yield {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}
+    for index in range(DELTA_COUNT):
+        yield {"type": "content_block_delta", "index": 0,
+               "delta": {"type": "text_delta", "text": f"t{index} "}}
+    yield {"type": "content_block_stop", "index": 0}
+    yield {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+           "usage": {"output_tokens": DELTA_COUNT}}
+    yield {"type": "message_stop"}
+
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    """The app served on a local port, talking to the fake provider."""
+    fake = FakeProviderServer()
+    threading.Thread(target=fake.serve_forever, daemon=True).start()
+
+    data_dir = tmp_path_factory.mktemp("data")
+    with pytest.MonkeyPatch.context() as env:
+        env.setenv("OPEN_AI_KEY", "test")
+        env.setenv("ANTHROPIC_KEY", "test")
+        env.setenv("OPENAI_BASE_URL", f"{fake.url}/v1")
+        env.setenv("ANTHROPIC_BASE_URL", fake.url)
+        env.setenv("HTTP_PREWARM_CONNECTIONS", "0")
+        env.setenv("USAGE_DB_PATH", str(data_dir / "usage.db"))
+        env.setenv("DOCUMENT_DIR", str(data_dir / "documents"))
+        main = importlib.import_module("src.main")
+
+        app_server = make_server("127.0.0.1", 0, main.app, threaded=True)
+        threading.Thread(target=app_server.serve_forever, daemon=True).start()
+        yield SimpleNamespace(main=main, fake=fake, port=app_server.server_port)
+
+        app_server.shutdown()
+        fake.shutdown()
+
+
+def generate_body(provider: str, prompt: str) -> bytes:
+    model = "gpt-4o" if provider == "openai" else "claude-3-5-sonnet-20241022"
+    return json.dumps({"model": model, "prompt": prompt}).encode()
+
+
+def start_generate(server, provider: str, prompt: str, headers: Dict[str, str]) -> Dict[str, object]:
+    """POST a generate request on a background thread; the dict fills in when it returns."""
+    reply: Dict[str, object] = {}
+
+    def send():
+        conn = http.client.HTTPConnection("127.0.0.1", server.port, timeout=30)
+        conn.request("POST", f"/api/{provider}/generate", body=generate_body(provider, prompt),
+                     headers={"Content-Type": "application/json", **headers})
+        response = conn.getresponse()
+        reply["status"] = response.status
+        reply["body"] = json.loads(response.read())
+        conn.close()
+
+    reply["thread"] = threading.Thread(target=send, daemon=True)
+    reply["thread"].start()
+    return reply
+
+
+def post(server, path: str) -> int:
+    conn = http.client.HTTPConnection("127.0.0.1", server.port, timeout=10)
+    conn.request("POST", path)
+    status = conn.getresponse().status
+    conn.close()
+    return status
+
+
+def metrics(server) -> Dict[str, object]:
+    conn = http.client.HTTPConnection("127.0.0.1", server.port, timeout=10)
+    conn.request("GET", "/api/metrics")
+    data = json.loads(conn.getresponse().read())["data"]
+    conn.close()
+    return data["requests"]
+
+
+def cancel_explicitly(server, provider: str) -> Dict[str, object]:
+    """Start a generation, cancel it through the cancel endpoint and wait for both ends."""
+    request_id = f"test-{uuid.uuid4().hex}"
+    call = server.fake.expect(request_id)
+    reply = start_generate(server, provider, request_id, {"X-Request-ID": request_id})
+    assert call.started.wait(CANCEL_TIMEOUT)
+
+    cancelled_at = time.monotonic()
+    assert post(server, f"/api/requests/{request_id}/cancel") == 200
+    assert call.ended.wait(CANCEL_TIMEOUT)
+    reply["thread"].join(CANCEL_TIMEOUT)
+    reply.update(call=call, request_id=request_id, upstream_close_s=time.monotonic() - cancelled_at)
+    return reply
+
+
+def disconnect_client(server, provider: str) -> UpstreamCall:
+    """Start a generation on a raw socket, close the socket and wait for the upstream to stop."""
+    marker = f"test-{uuid.uuid4().hex}"
+    call = server.fake.expect(marker)
+    body = generate_body(provider, marker)
+
+    client = socket.create_connection(("127.0.0.1", server.port))
+    client.sendall(
+        f"POST /api/{provider}/generate HTTP/1.1\r\nHost: localhost\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+    assert call.started.wait(CANCEL_TIMEOUT)
+    client.close()
+    assert call.ended.wait(CANCEL_TIMEOUT)
+    return call
+
+
+def wait_for_idle(server) -> Dict[str, object]:
+    """Wait until the server has unregistered every in-flight request."""
+    deadline = time.monotonic() + CANCEL_TIMEOUT
+    data = metrics(server)
+    while data["in_flight"] and time.monotonic() < deadline:
+        time.sleep(0.05)
+        data = metrics(server)
+    return data
+
+
+@pytest.mark.parametrize("provider", ["openai", "anthropic"])
+def test_cancel_endpoint_closes_upstream_stream(server, provider):
+    reply = cancel_explicitly(server, provider)
+
+    assert reply["status"] == 499
+    assert reply["call"].outcome == "closed_by_client"
+    assert reply["upstream_close_s"] < CANCEL_TIMEOUT
+    # A finished request can no longer be cancelled
+    assert post(server, f"/api/requests/{reply['request_id']}/cancel") == 404
+
+
+def test_generate_runs_to_completion_without_cancel(server):
+    marker = f"test-{uuid.uuid4().hex}"
+    call = server.fake.expect(marker)
+    reply = start_generate(server, "openai", marker, {})
+    reply["thread"].join(DELTA_COUNT * DELTA_INTERVAL + 5)
+
+    assert reply["status"] == 200
+    assert call.outcome == "completed"
+    assert reply["body"]["data"]["response"].startswith("t0 t1 ")
+
+
+@pytest.mark.parametrize("provider", ["openai", "anthropic"])
+def test_client_disconnect_cancels_upstream_request(server, provider):
+    call = disconnect_client(server, provider)
+
+    assert call.outcome == "closed_by_client"
+
+
+def test_cancelled_generation_is_recorded_in_usage_ledger(server):
+    reply = cancel_explicitly(server, "openai")
+    wait_for_idle(server)
+    server.main.usage_ledger.flush(5)
+
+    conn = sqlite3.connect(server.main.usage_ledger.db_path)
+    rows = conn.execute(
+        "SELECT status, input_tokens, output_tokens, cost_usd FROM usage_records "
+        "WHERE created_at >= ? ORDER BY id DESC LIMIT 1", (time.time() - 30,)
+    ).fetchall()
+    conn.close()
+
+    assert reply["status"] == 499
+    status, input_tokens, _, cost_usd = rows[0]
+    assert status == "cancelled"
+    # The provider never reported usage, so the prompt is billed by estimate
+    assert input_tokens > 0 and cost_usd > 0
+
+
+def test_websocket_cancel_stops_generation(server):
+    marker = f"test-{uuid.uuid4().hex}"
+    call = server.fake.expect(marker)
+    ws = simple_websocket.Client.connect(f"ws://127.0.0.1:{server.port}/api/ws/chat")
+    try:
+        ws.send(json.dumps({"type": "generate", "id": "1", "provider": "openai",
+                            "model": "gpt-4o", "prompt": marker}))
+        first = json.loads(ws.receive(timeout=CANCEL_TIMEOUT))
+        assert first == {"type": "token", "id": "1", "text": "t0 "}
+
+        ws.send(json.dumps({"type": "cancel", "id": "1"}))
+        deadline = time.monotonic() + CANCEL_TIMEOUT
+        message = first
+        while message["type"] == "token" and time.monotonic() < deadline:
+            message = json.loads(ws.receive(timeout=CANCEL_TIMEOUT))
+        assert message == {"type": "cancelled", "id": "1"}
+
+        # The connection stays usable for further messages
+        ws.send(json.dumps({"type": "ping"}))
+        assert json.loads(ws.receive(timeout=CANCEL_TIMEOUT)) == {"type": "pong"}
+    finally:
+        ws.close()
+
+    assert call.ended.wait(CANCEL_TIMEOUT)
+    assert call.outcome == "closed_by_client"
+
+
+def test_metrics_count_cancellations_by_reason(server):
+    before = wait_for_idle(server)
+    cancel_explicitly(server, "openai")
+    cancel_explicitly(server, "anthropic")
+    disconnect_client(server, "openai")
+    after = wait_for_idle(server)
+
+    def count(data, reason):
+        return data["cancelled"].get(reason, 0)
+
+    assert after["in_flight"] == 0
+    assert count(after, "explicit") - count(before, "explicit") == 2
+    assert count(after, "client_disconnect") - count(before, "client_disconnect") == 1
+    assert after["cancelled_total"] - before["cancelled_total"] == 3
+    assert after["completed"] == before["completed"]
@@ -0,0 +1,97 @@
+"""
+Chat Socket Tests
+
+Drives a ChatSocketSession over an in-memory WebSocket whose client has
+stopped reading, to check that cancel messages still get through once the
+send buffer is full.
+
+Author: Pradyun Magal
+Date: March 2025
+"""
+
+import json
+import queue
+import threading
+import time
+from typing import Iterator, Optional
+
+from src.cancellation.registry import CancellationToken, RequestRegistry
+from src.managers.base_manager import GenerationResult, GenerationStream
+from src.sockets.chat_socket import ChatSocketSession
+
+
+class StalledSocket:
+    """WebSocket stand-in whose client sends messages but never reads any."""
+
+    def __init__(self):
+        self.incoming: "queue.Queue[Optional[str]]" = queue.Queue()
+        self.unblock = threading.Event()
+        self.closed = False
+
+    def receive(self, timeout=None):
+        try:
+            message = self.incoming.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if message is None:
+            raise ConnectionError("client went away")
+        return message
+
+    def send(self, data):
+        # Block like a socket whose send buffer the client never drains
+        self.unblock.wait()
+
+    def close(self):
+        self.closed = True
+
+
+class EndlessManager:
+    """Manager stand-in that streams tokens until it is cancelled."""
+
+    def __init__(self):
+        self.cancel_token: Optional[CancellationToken] = None
+        self.started = threading.Event()
+
+    def stream(self, prompt, system_prompt="", client_key="", model=None, cancel_token=None, document=None):
+        self.cancel_token = cancel_token
+        self.started.set()
+
+        def chunks() -> Iterator[str]:
+            while not cancel_token.cancelled:
+                yield "token "
+
+        return GenerationStream(chunks(), GenerationResult(text="", provider="fake", model=model))
+
+
+def test_cancel_is_read_while_send_buffer_is_full():
+    ws = StalledSocket()
+    manager = EndlessManager()
+    session = ChatSocketSession(ws, {"fake": manager}, RequestRegistry())
+    runner = threading.Thread(target=session.run, daemon=True)
+    runner.start()
+
+    try:
+        ws.incoming.put(json.dumps({"type": "generate", "id": "1", "provider": "fake",
+                                    "model": "fake-model", "prompt": "hello"}))
+        assert manager.started.wait(2)
+        deadline = time.monotonic() + 2
+        while not session._outbound.full() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert session._outbound.full()
+
+        # Replies to these cannot be buffered; they must not hold up the cancel
+        ws.incoming.put(json.dumps({"type": "ping"}))
+        ws.incoming.put("not json")
+        ws.incoming.put(json.dumps({"type": "cancel", "id": "1"}))
+
+        deadline = time.monotonic() + 2
+        while not manager.cancel_token.cancelled and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert manager.cancel_token.cancelled
+        assert manager.cancel_token.reason == "explicit"
+    finally:
+        ws.unblock.set()
+        ws.incoming.put(None)
+        runner.join(5)
+
+    assert not runner.is_alive()